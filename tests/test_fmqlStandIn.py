@@ -0,0 +1,177 @@
+#
+## FMQL Stand In Tests
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Crawls of a small cached VistA served by FMQLStandIn, compressed and not,
+checked against the cache they were served from. Also the stand in over a
+zipped cache (as the bundled GOLD is) and an FMQL that doesn't batch
+DESCRIBE TYPES.
+
+Run from the top directory:
+$ python -m unittest discover tests
+"""
+
+import os
+import json
+import zlib
+import shutil
+import zipfile
+import tempfile
+import threading
+import unittest
+from vdm.copies.fmqlCacher import FMQLCacher
+from vdm.copies.fmqlCacheStores import makeCacheStore, CacheManifest
+from vdm.copies.fmqlHTTPPool import HTTPConnectionPool, decodeBody
+from vdm.copies.fmqlStandIn import FMQLStandIn, serveStandIn
+
+NO_BUILDS = 45
+BUILDS_LIMIT = 10
+# files and their subfiles
+FILES = [("2", None), ("2.01", "2"), ("9.6", None), ("9.61", "9.6"), ("9.7", None), ("200", None)]
+
+def buildEntry(ien):
+    return {"uri": {"type": "uri", "value": "9_6-%d" % ien, "label": "BUILD/B%d" % ien}, "name": {"type": "literal", "value": "B%d" % ien}, "description": {"type": "literal", "value": "Build %d of a package with a long enough description to compress " % ien * 3}}
+
+def makeSourceCache(cacheLocation):
+    """A VistA's cache as a crawl leaves it: schema and Builds (9.6) paged at CSTOP 10"""
+    store = makeCacheStore(cacheLocation)
+    manifest = CacheManifest(store)
+    def cache(query, reply):
+        store.put(query, reply)
+        manifest.recordQuery(query, reply)
+    cache("SELECT TYPES", json.dumps({"results": [dict({"number": number, "name": "FILE " + number}, **({"parent": parent} if parent else {"count": "10"})) for number, parent in FILES]}))
+    for number, parent in FILES:
+        cache("DESCRIBE TYPE " + number.replace(".", "_"), json.dumps({"number": number, "name": "FILE " + number, "fields": [{"number": ".01", "name": "NAME", "type": "4"}]}))
+    pages = NO_BUILDS / BUILDS_LIMIT + 1
+    for page in range(pages):
+        results = [buildEntry(ien) for ien in range(page * BUILDS_LIMIT + 1, min(NO_BUILDS, (page + 1) * BUILDS_LIMIT) + 1)]
+        cache("DESCRIBE 9_6 CSTOP 10 LIMIT %d OFFSET %d" % (BUILDS_LIMIT, page * BUILDS_LIMIT), json.dumps({"count": str(len(results)), "results": results}))
+    manifest.recordSchema(True, len(FILES))
+    manifest.recordDescribe("9_6", BUILDS_LIMIT, "10", pages, NO_BUILDS)
+    manifest.save()
+    store.close()
+
+class StandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, "SRC")
+        makeSourceCache(self.source)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def serve(self, standIn, compress=True):
+        server = serveStandIn(standIn, 0, compress=compress)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return "http://127.0.0.1:%d/fmqlEP" % server.server_address[1]
+
+    def crawl(self, fmqlEP, vistaLabel, asyncFetch=False):
+        """Schema and Builds of the stand in into a new cache. Returns its store and manifest."""
+        cacher = FMQLCacher(os.path.join(self.tmp, "Caches"))
+        cacher.setVista(vistaLabel, fmqlEP=fmqlEP, poolSize=4, asyncFetch=asyncFetch)
+        try:
+            self.assertEqual(len(list(cacher.describeSchemaTypes())), len(FILES))
+            builds = list(cacher.describeFileEntries("9_6", limit=BUILDS_LIMIT, cstop=10))
+        finally:
+            cacher.close()
+        self.assertEqual(builds, [buildEntry(ien) for ien in range(1, NO_BUILDS + 1)])
+        store = makeCacheStore(os.path.join(self.tmp, "Caches", vistaLabel))
+        return store, CacheManifest(store)
+
+    def assertSameSchema(self, store):
+        """Each DESCRIBE TYPE cached byte for byte as in the source"""
+        source = makeCacheStore(self.source)
+        for number, parent in FILES:
+            query = "DESCRIBE TYPE " + number.replace(".", "_")
+            self.assertEqual(store.get(query), source.get(query))
+
+    def pageQueries(self, store):
+        return [query for query in store.queries() if query.startswith("DESCRIBE 9_6 ")]
+
+    def testCompressedCrawl(self):
+        for asyncFetch in [False, True]:
+            store, manifest = self.crawl(self.serve(FMQLStandIn(self.source)), "Z%s" % asyncFetch, asyncFetch)
+            self.assertSameSchema(store)
+            pageQueries = self.pageQueries(store)
+            self.assertEqual(len(pageQueries), NO_BUILDS / BUILDS_LIMIT + 1)
+            for query in pageQueries:
+                info = manifest.queryInfo(query)
+                self.assertEqual(info["bytes"], len(store.get(query)))
+                self.assertTrue(info["wireBytes"] < info["bytes"], "%s sent uncompressed" % query)
+
+    def testUncompressedCrawl(self):
+        for asyncFetch in [False, True]:
+            store, manifest = self.crawl(self.serve(FMQLStandIn(self.source), compress=False), "U%s" % asyncFetch, asyncFetch)
+            self.assertSameSchema(store)
+            for query in self.pageQueries(store):
+                info = manifest.queryInfo(query)
+                self.assertEqual(info.get("wireBytes", info["bytes"]), info["bytes"])
+
+    def testAcceptEncoding(self):
+        standIn = FMQLStandIn(self.source)
+        query = "DESCRIBE 9_6 CSTOP 10 LIMIT 20 OFFSET 0"
+        for compress in [True, False]:
+            httpCPool = HTTPConnectionPool(self.serve(standIn, compress), 1)
+            transfer = {}
+            reply = httpCPool.query(query, transfer)
+            httpCPool.close()
+            self.assertEqual(reply, standIn.query(query))
+            self.assertEqual(transfer["wireBytes"] < len(reply), compress)
+
+    def testDecodeBody(self):
+        reply = json.dumps({"results": [buildEntry(ien) for ien in range(5)]})
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.assertEqual(decodeBody(compressor.compress(reply) + compressor.flush(), "gzip"), reply)
+        self.assertEqual(decodeBody(zlib.compress(reply), "deflate"), reply)
+        self.assertEqual(decodeBody(zlib.compress(reply)[2:-4], "Deflate"), reply) # raw
+        self.assertEqual(decodeBody(reply, None), reply)
+        self.assertRaises(IOError, decodeBody, reply, "gzip")
+        self.assertRaises(IOError, decodeBody, reply, "br")
+
+    def testZippedCache(self):
+        """As the bundled GOLD: a zipped cache directory without its manifest"""
+        zipped = os.path.join(self.tmp, "GOLD")
+        zipFile = zipfile.ZipFile(zipped + ".zip", "w", zipfile.ZIP_DEFLATED)
+        for fileName in os.listdir(self.source):
+            if fileName.endswith(".json"):
+                zipFile.write(os.path.join(self.source, fileName), "GOLD/" + fileName)
+        zipFile.close()
+        standIn = FMQLStandIn(zipped)
+        unzipped = FMQLStandIn(self.source)
+        self.assertEqual(json.loads(standIn.query("COUNT 9_6")), {"count": str(NO_BUILDS)})
+        for query in ["DESCRIBE 9_6 CSTOP 10 LIMIT 7 OFFSET 14", "DESCRIBE 9_6 LIMIT 7 AFTERIEN 40", "DESCRIBE 9_6-33 CSTOP 10", "DESCRIBE TYPE 9_6", "DESCRIBE TYPES 2,2_01"]:
+            self.assertEqual(json.loads(standIn.query(query)), json.loads(unzipped.query(query)))
+        self.assertTrue("error" in json.loads(standIn.query("DESCRIBE 9_6-46 CSTOP 10")))
+        self.assertTrue("error" in json.loads(standIn.query("COUNT 200")))
+
+    def testTypesBatching(self):
+        """Batched DESCRIBE TYPES where FMQL answers them, one by one where it errors"""
+        for batchTypes in [True, False]:
+            standIn = FMQLStandIn(self.source, batchTypes=batchTypes)
+            queries = []
+            query = standIn.query
+            def countingQuery(q, transfer=None):
+                queries.append(q)
+                return query(q, transfer)
+            standIn.query = countingQuery
+            store, manifest = self.crawl(self.serve(standIn), "B%s" % batchTypes)
+            self.assertSameSchema(store)
+            self.assertEqual(manifest.typesBatching(), batchTypes)
+            self.assertEqual(len([q for q in queries if q.startswith("DESCRIBE TYPE ")]), 0 if batchTypes else len(FILES))
+            self.assertFalse(manifest.deadLetters())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,13 +17,24 @@ VOLDEMORT (VDM)
 --access: access for FMQL RPC
 --verify: verify for FMQL RPC
 -r, --report: 'schema', 'builds', 'schemaBuilds'
+--async: crawl an (http) FMQL endpoint on an event loop, many queries in flight at once, rather than with threads
+--refresh: bring the cache of a VistA up to date before reporting. Only what its Installs (9.7) since the last refresh or crawl touched is refetched.
+-c, --crawl: cache (or with --refresh, refresh) every VistA of a fleet file at once rather than report. See vistaFleet for its format.
+--budget: most queries in flight across a fleet being crawled. Defaults to 60.
+--rate: most queries a second to send a VistA. Crawls slow further if its replies do.
+--bandwidth: most reply bytes a second to take from a VistA
+--hours: when --rate and --bandwidth apply, ex/ "07:00-19:00" (comma separate many). Defaults to always.
 
 Example using a full FMQL RESTful endpoint ...
 $ python -m vdm -v CGVISTA -f http://vista.caregraf.org/fmqlEP -r schema
 or to use the FMQL RPC directly ...
 $ python -m vdm -v CGVISTA --host "xx.xx.xx" --port 9201 --access "XXX" --verify "YYY" -r schema
+or to cache a fleet of VistAs ...
+$ python -m vdm -c fleet.json --budget 40
+or to go easy on a VistA in use during the working day ...
+$ python -m vdm -v VAVISTA --host "xx.xx.xx" --port 9201 --access "XXX" --verify "YYY" -r builds --rate 2 --hours "07:00-19:00"
 
-The first time VDM runs against a VistA, the majority of time taken is downloading meta data. Subsequent runs of VDM for that VistA will be much faster as they'll run off a cache. 
+The first time VDM runs against a VistA, the majority of time taken is downloading meta data. Subsequent runs of VDM for that VistA will be much faster as they'll run off a cache. Only builds that GOLD doesn't have are downloaded in full.
 
 Any VistA being reported on must have FMQL installed. 
 
@@ -40,14 +51,15 @@ from vdm.vistaSchemaComparer import VistaSchemaComparer
 from vdm.vistaBuilds import VistaBuilds
 from vdm.vistaBuildsComparer import VistaBuildsComparer
 from vdm.vistaOtherDiffer import VistaOtherDiffer
-from vdm.copies.fmqlCacher import FMQLCacher
+from vdm.vistaFleet import loadFleet, crawlFleet, makeLoadShaper, BUDGET
+from vdm.copies.fmqlCacher import FMQLCacher, CrawlIncomplete
 import pkg_resources
 from shutil import copy
-from zipfile import ZipFile
 
 def _makeEnvir():
     """
-    Create Caches and Reports directories and move GOLD into Caches
+    Create Caches and Reports directories and move GOLD into Caches. GOLD
+    stays zipped - FMQLCacher reads it in place.
 
     TODO:
     - move into a vdmEnvir module. After setup, it can provide access
@@ -57,12 +69,11 @@ def _makeEnvir():
         os.mkdir("Reports")
     if not os.path.exists("Caches"):
         os.mkdir("Caches")
-    if not os.path.exists("Caches/GOLD"):
+    if not (os.path.exists("Caches/GOLD") or os.path.exists("Caches/GOLD.zip")):
         # must run inside the package itself so __name__ works
         goldZipFile = pkg_resources.resource_filename(__name__, "resources/GOLD.zip")
         copy(goldZipFile, "Caches")   
         print "First time VDM is run - installing GOLD into %s" % (os.getcwd() + "/Caches")
-        ZipFile(os.getcwd() + "/Caches/GOLD.zip").extractall(os.getcwd() + "/Caches")
 
 def _runReport(reportType, goldCacher, otherCacher):
     if reportType == "schema":
@@ -70,11 +81,13 @@ def _runReport(reportType, goldCacher, otherCacher):
         reportLocation = vsr.compare()
         print "Schema Report written to %s" % os.path.abspath(reportLocation)
     elif reportType == "builds":
-        vbr = VistaBuildsComparer(VistaBuilds("GOLD", goldCacher), VistaBuilds(otherCacher.vistaLabel, otherCacher))
+        goldBuilds = VistaBuilds("GOLD", goldCacher)
+        vbr = VistaBuildsComparer(goldBuilds, VistaBuilds(otherCacher.vistaLabel, otherCacher, goldBuilds))
         reportLocation = vbr.compare()
         print "Builds Report written to %s" % os.path.abspath(reportLocation)
     elif reportType == "schemaBuilds":
-        vod = VistaOtherDiffer(VistaBuilds("GOLD", goldCacher), VistaBuilds(otherCacher.vistaLabel, otherCacher), VistaSchema("GOLD", goldCacher), VistaSchema(otherCacher.vistaLabel, otherCacher))
+        goldBuilds = VistaBuilds("GOLD", goldCacher)
+        vod = VistaOtherDiffer(goldBuilds, VistaBuilds(otherCacher.vistaLabel, otherCacher, goldBuilds), VistaSchema("GOLD", goldCacher), VistaSchema(otherCacher.vistaLabel, otherCacher))
         reportLocation = vod.report()
         print "Schema Builds Report written to %s" % os.path.abspath(reportLocation)        
     else:
@@ -96,7 +109,7 @@ def main():
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     _makeEnvir()
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hv:f:r:", ["help", "vista=", "fmqlep=", "report=", "host=", "port=", "access=", "verify="])
+        opts, args = getopt.getopt(sys.argv[1:], "hv:f:r:c:", ["help", "vista=", "fmqlep=", "report=", "host=", "port=", "access=", "verify=", "refresh", "async", "crawl=", "budget=", "rate=", "bandwidth=", "hours="])
     except getopt.GetoptError, err:
         print str(err)
         print __doc__
@@ -110,6 +123,11 @@ def main():
     access = ""
     verify = ""
     report = ""
+    refresh = False
+    asyncFetch = False
+    fleetFile = ""
+    budget = BUDGET
+    shaping = {}
     for o, a in opts:
         if o in ["-v", "--vista"]:
             vista = a
@@ -125,9 +143,29 @@ def main():
             verify = a
         elif o in ["-r", "--report"]:
             report = a
+        elif o in ["--refresh"]:
+            refresh = True
+        elif o in ["--async"]:
+            asyncFetch = True
+        elif o in ["-c", "--crawl"]:
+            fleetFile = a
+        elif o in ["--budget"]:
+            budget = int(a)
+        elif o in ["--rate"]:
+            shaping["rate"] = float(a)
+        elif o in ["--bandwidth"]:
+            shaping["bandwidth"] = int(a)
+        elif o in ["--hours"]:
+            shaping["hours"] = a
         elif o in ["-h", "--help"]:
             print __doc__
             sys.exit()
+    if fleetFile:
+        vistaDefs = loadFleet(fleetFile)
+        outcomes = crawlFleet(vistaDefs, "Caches", budget, refresh, shaping)
+        for vista in sorted(outcomes):
+            print "%s: %s" % (vista, outcomes[vista] or "cached")
+        sys.exit(1 if any(outcomes.values()) or len(outcomes) != len(vistaDefs) else 0)
     if not report:
         sys.exit()
     if vista == "CGVISTA":
@@ -137,8 +175,18 @@ def main():
     goldCacher = FMQLCacher("Caches")
     goldCacher.setVista("GOLD")
     otherCacher = FMQLCacher("Caches")
-    otherCacher.setVista(vista, fmqlEP=fmqlEP, host=host, port=int(port), access=access, verify=verify)
-    _runReport(report, goldCacher, otherCacher)
+    otherCacher.setVista(vista, fmqlEP=fmqlEP, host=host, port=int(port), access=access, verify=verify, asyncFetch=asyncFetch, loadShaper=makeLoadShaper(shaping, vista))
+    try:
+        if refresh:
+            newBuilds = otherCacher.refresh()
+            print "Refreshed %s - %d builds installed since its last refresh" % (vista, len(newBuilds))
+        _runReport(report, goldCacher, otherCacher)
+    except CrawlIncomplete, ci:
+        print str(ci)
+        sys.exit(1)
+    finally:
+        goldCacher.close()
+        otherCacher.close()
     
 if __name__ == "__main__":
     main()
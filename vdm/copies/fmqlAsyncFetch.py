@@ -0,0 +1,233 @@
+#
+## FMQL Async Fetch
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Event loop alternative to a FMQLCacher's fetcher threads for crawls of an
+FMQL web endpoint (fmqlEP). Every query is a non-blocking HTTP GET on one
+asyncore loop in the caller's thread so hundreds can be in flight at once
+without a thread each. How many go to one host at a time is capped
+(maxPerHost) so the server, not Python, sets the pace. Within that cap, 
+the number in flight is tuned as replies come back (AdaptiveConcurrency)
+and, with a budget (CrawlBudget), shared with the crawls of other VistAs.
+With a loadShaper (LoadShaper), queries go no faster than it allows.
+
+Python 2 has no asyncio: asyncore is the standard library's event loop.
+
+AsyncFetchPool has the same fetch/close as FetchPool so FMQLCacher uses
+either.
+
+TODO:
+- https endpoints (asyncore has no TLS) - these use the fetcher threads
+- keep connections alive rather than one connection per query
+"""
+
+import re
+import sys
+import time
+import socket
+import asyncore
+import urllib
+import urlparse
+import heapq
+import logging
+import threading
+from collections import deque
+from fmqlConcurrency import AdaptiveConcurrency, RetryPolicy, CrawlSummary
+from fmqlHTTPPool import ACCEPT_ENCODING, decodeBody
+
+__all__ = ['AsyncFetchPool']
+
+class AsyncFetchPool(object):
+    """
+    Fetches batches of queries from an FMQL endpoint on one event loop.
+    onReply(query, reply, wireBytes) is called (on the caller's thread) with
+    each reply as it arrives. Replies are asked for compressed: wireBytes is
+    the size as sent, reply is decoded.
+
+    fetch blocks until a batch is done and returns its CrawlSummary,
+    calling onCached(query), if given, as each is cached. There is one loop
+    so batches fetched from many threads take turns. As with FetchPool,
+    a query that fails (can't connect, not HTTP 200, timed out, onReply 
+    returned False ie/ a corrupt reply) is retried with backoff and, if it
+    fails every retry, is one of the summary's dead letters.
+    """
+    # Most queries in flight to one host
+    MAX_PER_HOST = 100
+
+    # Seconds a query may take, connect to last byte
+    TIMEOUT = 300
+
+    def __init__(self, fmqlEP, onReply, maxPerHost=MAX_PER_HOST, minPerHost=None, label="", retryPolicy=None, budget=None, loadShaper=None):
+        parsedEP = urlparse.urlparse(fmqlEP)
+        if parsedEP.scheme != "http":
+            raise ValueError("Async fetch only supports http endpoints, not %s" % fmqlEP)
+        self.__host = parsedEP.hostname
+        self.__port = parsedEP.port or 80
+        self.__path = parsedEP.path or "/"
+        self.__onReply = onReply
+        self.concurrency = AdaptiveConcurrency(minPerHost or maxPerHost, maxPerHost, label)
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.__label = label
+        self.__budget = budget
+        self.__loadShaper = loadShaper
+        self.__address = None
+        self.__fetchLock = threading.Lock()
+
+    def fetch(self, queries, onCached=None):
+        with self.__fetchLock:
+            return self.__fetch(queries, onCached)
+
+    def __fetch(self, queries, onCached):
+        self.__summary = CrawlSummary(len(queries))
+        self.__onCached = onCached
+        if not self.__address and queries:
+            self.__address = (socket.gethostbyname(self.__host), self.__port)
+        self.__pending = deque((query, 1) for query in queries)
+        self.__retries = [] # heap of (when, query, attempt)
+        socketMap = {}
+        while self.__pending or self.__retries or socketMap:
+            now = time.time()
+            while self.__retries and self.__retries[0][0] <= now:
+                when, query, attempt = heapq.heappop(self.__retries)
+                self.__pending.append((query, attempt))
+            shapeDelay = 0
+            while self.__pending and len(socketMap) < self.concurrency.limit:
+                if self.__loadShaper:
+                    shapeDelay = self.__loadShaper.delay()
+                    if shapeDelay:
+                        break
+                if self.__budget and not self.__budget.tryAcquire(self.__label):
+                    break
+                if self.__loadShaper:
+                    self.__loadShaper.take()
+                query, attempt = self.__pending.popleft()
+                _FMQLRequest(self, query, attempt, socketMap)
+            if not socketMap: # waiting on the budget or shaper or only retries left
+                waits = [max(0.1, shapeDelay)] if self.__pending else []
+                if self.__retries:
+                    waits.append(max(0, self.__retries[0][0] - time.time()))
+                time.sleep(min(waits))
+                continue
+            asyncore.loop(timeout=min(1, shapeDelay) if shapeDelay else 1, map=socketMap, count=1)
+            now = time.time()
+            for request in socketMap.values():
+                if now - request.started > AsyncFetchPool.TIMEOUT:
+                    request.fail(socket.timeout("timed out"))
+        self.__summary.finish()
+        return self.__summary
+
+    def close(self):
+        pass # nothing outlives a fetch
+
+    def requestLine(self, query):
+        return "GET %s?%s HTTP/1.0\r\nHost: %s\r\nAccept: application/json\r\nAccept-Encoding: %s\r\n\r\n" % (self.__path, urllib.urlencode({"fmql": query}), self.__host, ACCEPT_ENCODING)
+
+    @property
+    def address(self):
+        return self.__address
+
+    def completed(self, query, attempt, response, latency):
+        if self.__budget:
+            self.__budget.release(self.__label)
+        try:
+            body, contentEncoding = _body(query, response)
+            reply = decodeBody(body, contentEncoding)
+            ok = self.__onReply(query, reply, len(body)) is not False
+        except Exception:
+            self.__retryOrGiveUp(query, attempt, str(sys.exc_info()[1]), latency, len(response))
+            return
+        if not ok:
+            self.__retryOrGiveUp(query, attempt, "reply isn't JSON", latency, len(response))
+            return
+        self.concurrency.record(latency, len(response), True)
+        if self.__loadShaper:
+            self.__loadShaper.record(latency, len(response))
+        self.__summary.recordFetched(attempt, len(reply), len(body))
+        if self.__onCached:
+            self.__onCached(query)
+
+    def failed(self, query, attempt, error, latency):
+        if self.__budget:
+            self.__budget.release(self.__label)
+        self.__retryOrGiveUp(query, attempt, error, latency)
+        
+    def __retryOrGiveUp(self, query, attempt, error, latency, noBytes=0):
+        self.concurrency.record(latency, 0, False)
+        if self.__loadShaper:
+            self.__loadShaper.record(latency, noBytes, False)
+        if attempt > self.retryPolicy.maxRetries:
+            logging.error("Failed to retrieve %s (%s) - giving up after %d attempts" % (query, error, attempt))
+            self.__summary.recordDead(query, error, attempt)
+            return
+        delay = self.retryPolicy.delay(attempt - 1)
+        logging.warning("Failed to retrieve %s (%s) - retrying in %.1fs" % (query, error, delay))
+        self.__summary.recordRetry()
+        heapq.heappush(self.__retries, (time.time() + delay, query, attempt + 1))
+
+def _body(query, response):
+    """(Body, its Content-Encoding) of a whole HTTP/1.0 response. Anything but a 200 is an error."""
+    head, sep, body = response.partition("\r\n\r\n")
+    match = re.match(r'HTTP/\d\.\d (\d{3})', head)
+    if not (sep and match):
+        raise IOError("Bad HTTP response")
+    if match.group(1) != "200":
+        raise IOError("HTTP %s" % match.group(1))
+    contentLength = re.search(r'\r\nContent-Length:\s*(\d+)', head, re.I)
+    if contentLength and int(contentLength.group(1)) != len(body):
+        raise IOError("Incomplete reply - %d of %s bytes" % (len(body), contentLength.group(1)))
+    contentEncoding = re.search(r'\r\nContent-Encoding:\s*([^\r]+)', head, re.I)
+    return body, contentEncoding.group(1) if contentEncoding else None
+
+class _FMQLRequest(asyncore.dispatcher):
+    """One query: connect, send the GET, read until the server closes"""
+    def __init__(self, pool, query, attempt, socketMap):
+        asyncore.dispatcher.__init__(self, map=socketMap)
+        self.__pool = pool
+        self.fmqlQuery = query
+        self.__attempt = attempt
+        self.started = time.time()
+        self.__out = pool.requestLine(query)
+        self.__in = []
+        self.__finished = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(pool.address)
+        except socket.error:
+            self.fail(sys.exc_info()[1])
+
+    def writable(self):
+        return bool(self.__out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.__out)
+        self.__out = self.__out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.__in.append(data)
+
+    def handle_close(self):
+        if self.__finished:
+            return
+        self.__finished = True
+        self.close()
+        self.__pool.completed(self.fmqlQuery, self.__attempt, "".join(self.__in), time.time() - self.started)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, exc):
+        if self.__finished:
+            return
+        self.__finished = True
+        self.close()
+        self.__pool.failed(self.fmqlQuery, self.__attempt, str(exc) or exc.__class__.__name__, time.time() - self.started)
@@ -0,0 +1,990 @@
+#
+## FMQL Cache Stores
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Module of storage backends ("stores") for a Cache of FMQL responses. An FMQLCacher
+keeps one store per VistA. A store keys each reply by its (normalized) query and
+holds the reply's raw JSON. Alongside its replies, a store keeps named "meta"
+documents such as the VistA's CacheManifest.
+
+- DirectoryCacheStore: the original layout, one "<query>.json" file per reply
+- SQLiteCacheStore: every reply in one indexed SQLite file, "fmqlCache.db"
+- BlobCacheStore: each distinct reply kept once, by its hash, in a blob
+directory shared by all VistAs. A VistA's store indexes its queries to hashes.
+- ZipCacheStore: read-only, serves replies straight from a zipped cache like
+the bundled GOLD.zip
+
+Stores can compress what they write - zlib, gzip or bz2 - and decompress
+whatever they read, compressed or not, so a cache can be part compressed. A
+store remembers its compression in its meta.
+
+Replies can be read whole (get) or opened as a stream (open). iterReplyResults
+decodes the entries of a reply's "results" one at a time from such a stream
+so a page of big entries need not be decoded all at once.
+
+An existing directory cache moves into SQLite (or blobs with -t BLOB) with:
+$ python fmqlCacheStores.py migrate Caches/VAVISTA
+After that, makeCacheStore (and so FMQLCacher) picks the migrated store for that VistA.
+Blobs no VistA refers to any more are removed with:
+$ python fmqlCacheStores.py collect Caches
+An existing cache (of either type) is compressed in place with:
+$ python fmqlCacheStores.py -c zlib compress Caches/VAVISTA
+
+TODO:
+- compact blob index logs (rewrite without superseded lines)
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import hashlib
+import getopt
+import sqlite3
+import zipfile
+import zlib
+import gzip
+import bz2
+import StringIO
+import threading
+import logging
+
+__all__ = ['DirectoryCacheStore', 'SQLiteCacheStore', 'BlobCacheStore', 'ZipCacheStore', 'collectBlobs', 'CacheManifest', 'makeCacheStore', 'migrateCacheStore', 'compressCacheStore', 'normalizeQuery', 'iterReplyResults']
+
+def normalizeQuery(query):
+    """
+    Queries that differ only in spacing get the same reply so share a key
+    """
+    return re.sub(r'\s+', ' ', query.strip())
+
+# Compression: file suffix and leading "magic" bytes. Not lzma - no Python 2 stdlib support.
+COMPRESSIONS = {"zlib": (".z", "\x78"), "gzip": (".gz", "\x1f\x8b"), "bz2": (".bz2", "BZh")}
+
+def compressReply(reply, compression):
+    if not compression:
+        return reply
+    if compression == "zlib":
+        return zlib.compress(reply)
+    if compression == "gzip":
+        gzBuffer = StringIO.StringIO()
+        gzFile = gzip.GzipFile(fileobj=gzBuffer, mode="wb")
+        gzFile.write(reply)
+        gzFile.close()
+        return gzBuffer.getvalue()
+    if compression == "bz2":
+        return bz2.compress(reply)
+    raise ValueError("Unknown compression %s" % compression)
+
+def decompressReply(data):
+    """Sniffs compression from leading bytes. JSON never starts with them."""
+    if data.startswith(COMPRESSIONS["zlib"][1]):
+        return zlib.decompress(data)
+    if data.startswith(COMPRESSIONS["gzip"][1]):
+        return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+    if data.startswith(COMPRESSIONS["bz2"][1]):
+        return bz2.decompress(data)
+    return data
+
+class _ZlibFile(object):
+    """Read side of a zlib compressed file, decompressing as read"""
+    def __init__(self, fileName):
+        self.__file = open(fileName, "rb")
+        self.__decompressor = zlib.decompressobj()
+        self.__pending = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.__pending) < size:
+            chunk = self.__file.read(65536)
+            if not chunk:
+                self.__pending += self.__decompressor.flush()
+                break
+            self.__pending += self.__decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self.__pending)
+        data, self.__pending = self.__pending[:size], self.__pending[size:]
+        return data
+
+    def close(self):
+        self.__file.close()
+
+class DirectoryCacheStore(object):
+    """
+    One JSON file per reply, named for its query. Lists the directory once
+    and then answers "is it cached?" from memory. A compressed reply's file
+    has a suffix for its compression ex/ "SELECT TYPES.json.gz".
+    """
+    def __init__(self, cacheLocation, compression=None):
+        if not os.path.exists(cacheLocation):
+            os.mkdir(cacheLocation)
+        self.cacheLocation = cacheLocation
+        self.compression = compression
+        self.__lock = threading.Lock()
+        self.__index = None
+
+    def __str__(self):
+        return "Directory Store %s" % self.cacheLocation
+
+    def queries(self):
+        with self.__lock:
+            return set(self.__loadIndex())
+
+    def contains(self, query):
+        with self.__lock:
+            return normalizeQuery(query) in self.__loadIndex()
+
+    def __loadIndex(self):
+        """query -> name of its file"""
+        if self.__index is None:
+            self.__index = {}
+            for fileName in os.listdir(self.cacheLocation):
+                match = re.match(r'(.+)\.json(\.z|\.gz|\.bz2)?$', fileName)
+                if match:
+                    self.__index[match.group(1)] = fileName
+        return self.__index
+
+    def get(self, query):
+        """Raw (decompressed) reply or None if the query isn't cached"""
+        queryFile = self.open(query)
+        if queryFile is None:
+            return None
+        try:
+            return queryFile.read()
+        finally:
+            queryFile.close()
+
+    def getMany(self, queries):
+        return dict((query, self.get(query)) for query in queries if self.contains(query))
+
+    def open(self, query):
+        """File-like reply, decompressing as read, or None. Caller closes it."""
+        query = normalizeQuery(query)
+        with self.__lock:
+            fileName = self.__loadIndex().get(query)
+        if fileName is None:
+            return None
+        fileName = self.cacheLocation + "/" + fileName
+        if fileName.endswith(".z"):
+            return _ZlibFile(fileName)
+        if fileName.endswith(".gz"):
+            return gzip.GzipFile(fileName, "rb")
+        if fileName.endswith(".bz2"):
+            return bz2.BZ2File(fileName, "rb")
+        return open(fileName, "rb")
+
+    def put(self, query, reply):
+        query = normalizeQuery(query)
+        fileName = query + ".json" + (COMPRESSIONS[self.compression][0] if self.compression else "")
+        with open(self.cacheLocation + "/" + fileName, "wb") as queryFile:
+            queryFile.write(compressReply(reply, self.compression))
+        with self.__lock:
+            index = self.__loadIndex()
+            # replaces a reply stored with another compression
+            if query in index and index[query] != fileName:
+                os.remove(self.cacheLocation + "/" + index[query])
+            index[query] = fileName
+
+    def remove(self, query):
+        query = normalizeQuery(query)
+        with self.__lock:
+            fileName = self.__loadIndex().pop(query, None)
+        if fileName:
+            os.remove(self.cacheLocation + "/" + fileName)
+
+    def putMany(self, items):
+        for query, reply in items:
+            self.put(query, reply)
+
+    def getMeta(self, name):
+        metaFile = self.cacheLocation + "/" + name + ".meta"
+        if not os.path.isfile(metaFile):
+            return None
+        with open(metaFile, "rb") as mf:
+            return mf.read()
+
+    def putMeta(self, name, value):
+        with open(self.cacheLocation + "/" + name + ".meta", "wb") as mf:
+            mf.write(value)
+
+    def close(self):
+        pass
+
+class SQLiteCacheStore(object):
+    """
+    All of a VistA's replies in one SQLite file. One file handle rather than
+    thousands of files and bulk reads and writes in single statements. A 
+    compressed reply is stored as its compressed blob.
+
+    Connection is shared by crawl threads so access is serialized.
+    """
+    DB_FILE = "fmqlCache.db"
+
+    # SQLite limits the number of variables in one statement
+    __BATCH = 500
+
+    def __init__(self, cacheLocation, compression=None):
+        if not os.path.exists(cacheLocation):
+            os.mkdir(cacheLocation)
+        self.cacheLocation = cacheLocation
+        self.compression = compression
+        self.__lock = threading.Lock()
+        self.__index = None
+        self.__db = sqlite3.connect(os.path.join(cacheLocation, SQLiteCacheStore.DB_FILE), check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS replies (query TEXT PRIMARY KEY, reply BLOB)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)")
+        self.__db.commit()
+
+    def __str__(self):
+        return "SQLite Store %s" % self.cacheLocation
+
+    def queries(self):
+        with self.__lock:
+            return set(self.__loadIndex())
+
+    def contains(self, query):
+        with self.__lock:
+            return normalizeQuery(query) in self.__loadIndex()
+
+    def __loadIndex(self):
+        if self.__index is None:
+            self.__index = set(row[0] for row in self.__db.execute("SELECT query FROM replies"))
+        return self.__index
+
+    def get(self, query):
+        query = normalizeQuery(query)
+        with self.__lock:
+            row = self.__db.execute("SELECT reply FROM replies WHERE query = ?", (query,)).fetchone()
+        return decompressReply(str(row[0])) if row else None
+
+    def getMany(self, queries):
+        queries = [normalizeQuery(query) for query in queries]
+        replies = {}
+        for i in range(0, len(queries), SQLiteCacheStore.__BATCH):
+            batch = queries[i:i + SQLiteCacheStore.__BATCH]
+            with self.__lock:
+                rows = self.__db.execute("SELECT query, reply FROM replies WHERE query IN (%s)" % ",".join("?" * len(batch)), batch).fetchall()
+            for query, reply in rows:
+                replies[query] = decompressReply(str(reply))
+        return replies
+
+    def open(self, query):
+        reply = self.get(query)
+        return None if reply is None else StringIO.StringIO(reply)
+
+    def put(self, query, reply):
+        self.putMany([(query, reply)])
+
+    def putMany(self, items):
+        items = [(normalizeQuery(query), sqlite3.Binary(compressReply(reply, self.compression))) for query, reply in items]
+        with self.__lock:
+            self.__db.executemany("INSERT OR REPLACE INTO replies (query, reply) VALUES (?, ?)", items)
+            self.__db.commit()
+            if self.__index is not None:
+                self.__index.update(query for query, reply in items)
+
+    def getMeta(self, name):
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return str(row[0]) if row else None
+
+    def putMeta(self, name, value):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, sqlite3.Binary(value)))
+            self.__db.commit()
+
+    def remove(self, query):
+        query = normalizeQuery(query)
+        with self.__lock:
+            self.__db.execute("DELETE FROM replies WHERE query = ?", (query,))
+            self.__db.commit()
+            if self.__index is not None:
+                self.__index.discard(query)
+
+    def vacuum(self):
+        """Give back space freed by removing or compressing replies"""
+        with self.__lock:
+            self.__db.execute("VACUUM")
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+class BlobCacheStore(object):
+    """
+    Replies kept once by content in a blob directory shared by every VistA
+    under the same Caches directory, "Caches/Blobs/<ab>/<sha1>". A VistA's
+    store is just an index of its queries to the hashes of their replies.
+    Most DESCRIBE TYPE replies of a VA-derived VistA are the same as GOLD's
+    so a fleet of VistAs holds one copy of each.
+
+    The index is a log, "blobIndex.log", of "<hash> <query>" and "- <query>"
+    (removed) lines. Later lines win. Appending keeps a put cheap. A blob 
+    has the suffix of its compression ex/ "<sha1>.z". Blobs no VistA refers 
+    to are removed with collectBlobs.
+    """
+    BLOBS_DIR = "Blobs"
+    INDEX_FILE = "blobIndex.log"
+
+    def __init__(self, cacheLocation, compression=None):
+        if not os.path.exists(cacheLocation):
+            os.mkdir(cacheLocation)
+        self.cacheLocation = cacheLocation
+        self.compression = compression
+        self.blobsLocation = os.path.join(os.path.dirname(os.path.abspath(cacheLocation)), BlobCacheStore.BLOBS_DIR)
+        if not os.path.exists(self.blobsLocation):
+            os.mkdir(self.blobsLocation)
+        self.__lock = threading.Lock()
+        self.__index = None
+
+    def __str__(self):
+        return "Blob Store %s" % self.cacheLocation
+
+    def queries(self):
+        with self.__lock:
+            return set(self.__loadIndex())
+
+    def contains(self, query):
+        with self.__lock:
+            return normalizeQuery(query) in self.__loadIndex()
+
+    def replyHash(self, query):
+        """sha1 of the (decompressed) reply or None if the query isn't cached"""
+        with self.__lock:
+            return self.__loadIndex().get(normalizeQuery(query))
+
+    def __loadIndex(self):
+        """query -> hash of its reply"""
+        if self.__index is None:
+            self.__index = readBlobIndex(self.cacheLocation)
+        return self.__index
+
+    def __blobFile(self, sha1):
+        """Blob of a hash, whatever its compression, or None"""
+        blobBase = os.path.join(self.blobsLocation, sha1[:2], sha1)
+        for suffix in [""] + [suffix for suffix, magic in COMPRESSIONS.values()]:
+            if os.path.isfile(blobBase + suffix):
+                return blobBase + suffix
+        return None
+
+    def get(self, query):
+        replyFile = self.open(query)
+        if replyFile is None:
+            return None
+        try:
+            return replyFile.read()
+        finally:
+            replyFile.close()
+
+    def getMany(self, queries):
+        return dict((query, self.get(query)) for query in queries if self.contains(query))
+
+    def open(self, query):
+        sha1 = self.replyHash(query)
+        if sha1 is None:
+            return None
+        blobFile = self.__blobFile(sha1)
+        if blobFile is None:
+            raise Exception("%s: blob %s of %s is missing - exiting" % (self, sha1, query))
+        if blobFile.endswith(".z"):
+            return _ZlibFile(blobFile)
+        if blobFile.endswith(".gz"):
+            return gzip.GzipFile(blobFile, "rb")
+        if blobFile.endswith(".bz2"):
+            return bz2.BZ2File(blobFile, "rb")
+        return open(blobFile, "rb")
+
+    def put(self, query, reply):
+        self.putMany([(query, reply)])
+
+    def putMany(self, items):
+        lines = []
+        for query, reply in items:
+            sha1 = hashlib.sha1(reply).hexdigest()
+            self.__putBlob(sha1, reply)
+            lines.append((normalizeQuery(query), sha1))
+        with self.__lock:
+            index = self.__loadIndex()
+            with open(os.path.join(self.cacheLocation, BlobCacheStore.INDEX_FILE), "ab") as indexFile:
+                for query, sha1 in lines:
+                    indexFile.write("%s %s\n" % (sha1, query.encode("utf-8")))
+                    index[query] = sha1
+
+    def __putBlob(self, sha1, reply):
+        """
+        Written once, with this store's compression. A blob with another
+        compression is replaced. Written aside and renamed into place so a
+        reader (of any VistA) never sees part of a blob.
+        """
+        blobBase = os.path.join(self.blobsLocation, sha1[:2], sha1)
+        blobFile = blobBase + (COMPRESSIONS[self.compression][0] if self.compression else "")
+        existingFile = self.__blobFile(sha1)
+        if existingFile == blobFile:
+            return
+        if not os.path.exists(os.path.dirname(blobBase)):
+            try:
+                os.mkdir(os.path.dirname(blobBase))
+            except OSError:
+                pass # another thread made it
+        tmpFile = "%s.%d.%d.tmp" % (blobBase, os.getpid(), threading.current_thread().ident)
+        with open(tmpFile, "wb") as bf:
+            bf.write(compressReply(reply, self.compression))
+        os.rename(tmpFile, blobFile)
+        if existingFile:
+            os.remove(existingFile)
+
+    def remove(self, query):
+        """The blob stays - other VistAs may share it"""
+        query = normalizeQuery(query)
+        with self.__lock:
+            if self.__loadIndex().pop(query, None) is None:
+                return
+            with open(os.path.join(self.cacheLocation, BlobCacheStore.INDEX_FILE), "ab") as indexFile:
+                indexFile.write("- %s\n" % query.encode("utf-8"))
+
+    def getMeta(self, name):
+        metaFile = self.cacheLocation + "/" + name + ".meta"
+        if not os.path.isfile(metaFile):
+            return None
+        with open(metaFile, "rb") as mf:
+            return mf.read()
+
+    def putMeta(self, name, value):
+        with open(self.cacheLocation + "/" + name + ".meta", "wb") as mf:
+            mf.write(value)
+
+    def close(self):
+        pass
+
+def readBlobIndex(cacheLocation):
+    """query -> hash from a VistA's blob index log. Empty if there is none."""
+    index = {}
+    indexFileName = os.path.join(cacheLocation, BlobCacheStore.INDEX_FILE)
+    if not os.path.isfile(indexFileName):
+        return index
+    with open(indexFileName, "rb") as indexFile:
+        for line in indexFile:
+            if not line.endswith("\n"):
+                break # torn last line of a crashed write
+            sha1, query = line[:-1].split(" ", 1)
+            query = query.decode("utf-8")
+            if sha1 == "-":
+                index.pop(query, None)
+            else:
+                index[query] = sha1
+    return index
+
+def collectBlobs(cachesLocation):
+    """
+    Remove the blobs that no VistA in cachesLocation refers to. Run when
+    no crawl is writing. Returns the number removed.
+    """
+    blobsLocation = os.path.join(cachesLocation, BlobCacheStore.BLOBS_DIR)
+    if not os.path.isdir(blobsLocation):
+        return 0
+    referenced = set()
+    for vistaDir in os.listdir(cachesLocation):
+        referenced.update(readBlobIndex(os.path.join(cachesLocation, vistaDir)).values())
+    noRemoved = 0
+    for blobDir in os.listdir(blobsLocation):
+        for blobFileName in os.listdir(os.path.join(blobsLocation, blobDir)):
+            if blobFileName.split(".")[0] not in referenced:
+                os.remove(os.path.join(blobsLocation, blobDir, blobFileName))
+                noRemoved += 1
+    return noRemoved
+
+class ZipCacheStore(object):
+    """
+    Read-only store over a zipped cache, "<cacheLocation>.zip". Members are
+    either "<VISTA>/<query>.json" (a zipped cache directory) or "<query>.json".
+    The member index is built once and only the members asked for are
+    decompressed.
+
+    zipfile shares one file handle between reads so reads are serialized.
+    """
+    def __init__(self, cacheLocation, compression=None):
+        if compression:
+            raise ValueError("Zip Store %s.zip is read-only - can't compress it" % cacheLocation)
+        self.cacheLocation = cacheLocation
+        self.compression = None
+        self.__lock = threading.Lock()
+        self.__zip = zipfile.ZipFile(cacheLocation + ".zip", "r")
+        vistaDir = os.path.basename(cacheLocation)
+        self.__index = {}
+        self.__metaIndex = {}
+        for member in self.__zip.infolist():
+            match = re.match(r'(?:([^/]+)/)?([^/]+)\.(json|meta)$', member.filename)
+            if match and match.group(1) in (None, vistaDir):
+                if match.group(3) == "json":
+                    self.__index[match.group(2)] = member
+                else:
+                    self.__metaIndex[match.group(2)] = member
+
+    def __str__(self):
+        return "Zip Store %s.zip" % self.cacheLocation
+
+    def queries(self):
+        return set(self.__index)
+
+    def contains(self, query):
+        return normalizeQuery(query) in self.__index
+
+    def get(self, query):
+        query = normalizeQuery(query)
+        if query not in self.__index:
+            return None
+        with self.__lock:
+            return self.__zip.read(self.__index[query])
+
+    def getMany(self, queries):
+        return dict((query, self.get(query)) for query in queries if self.contains(query))
+
+    def open(self, query):
+        """Decompresses as read. Each open has its own handle on the zip."""
+        query = normalizeQuery(query)
+        if query not in self.__index:
+            return None
+        with self.__lock:
+            return self.__zip.open(self.__index[query])
+
+    def put(self, query, reply):
+        raise Exception("%s is read-only - can't cache %s" % (self, query))
+
+    def putMany(self, items):
+        raise Exception("%s is read-only" % self)
+
+    def remove(self, query):
+        raise Exception("%s is read-only" % self)
+
+    def getMeta(self, name):
+        if name not in self.__metaIndex:
+            return None
+        with self.__lock:
+            return self.__zip.read(self.__metaIndex[name])
+
+    def putMeta(self, name, value):
+        pass # read-only: meta stays in memory
+
+    def close(self):
+        with self.__lock:
+            self.__zip.close()
+
+class CacheManifest(object):
+    """
+    What a VistA's cache holds so that "is it cached?" is a lookup, not a
+    probe of the store:
+    - every cached query with its reply's size (bytes), its sha1 (hash) and 
+    when it was fetched. If it came compressed, its size as sent (wireBytes). Equal hashes mean identical replies, even across VistAs.
+    - whether the schema (SELECT TYPES and every DESCRIBE TYPE) is complete
+    - for each file paged through with DESCRIBE, the page count and entry
+    count for its limit and cstop
+    - for each DESCRIBE crawl still under way, its plan (the COUNT and so
+    the pages expected) so an interrupted crawl can resume
+    - for AFTERIEN (cursor) crawls, the IEN each page starts after
+    - the page size (limit) chosen for each file and cstop, with the entry
+    size and time it was chosen from
+    - queries that failed every retry of a crawl ("dead letters") until
+    they are cached
+    - whether the VistA's FMQL answers batched DESCRIBE TYPES queries
+
+    Crawl threads record pages as they arrive and checkpoint the manifest
+    every few pages so little progress is lost if a crawl dies.
+
+    A cache from before manifests gets one built from its store's index. Its
+    queries have no sizes or fetch times and its schema and paged files are
+    "unknown" until checked.
+    """
+    VERSION = 1
+
+    # Unsaved records before a checkpoint saves
+    CHECKPOINT_EVERY = 10
+
+    def __init__(self, store):
+        self.__store = store
+        self.__lock = threading.Lock()
+        self.__unsaved = 0
+        manifest = store.getMeta("manifest")
+        manifest = json.loads(manifest) if manifest else None
+        if manifest and manifest["version"] == CacheManifest.VERSION:
+            self.__manifest = manifest
+            self.__dirty = False
+        else:
+            self.__manifest = {"version": CacheManifest.VERSION, "queries": dict((query, {}) for query in store.queries()), "schema": None, "describes": {}, "plans": {}}
+            self.__dirty = True
+
+    def isCached(self, query):
+        return normalizeQuery(query) in self.__manifest["queries"]
+
+    def queryInfo(self, query):
+        """{"bytes": , "fetched": , "hash": [, "wireBytes": ]} or None if not cached"""
+        return self.__manifest["queries"].get(normalizeQuery(query))
+
+    def recordQuery(self, query, reply, wireBytes=None):
+        """wireBytes: size of the reply as sent if it came compressed"""
+        with self.__lock:
+            self.__manifest["queries"][normalizeQuery(query)] = {"bytes": len(reply), "fetched": int(time.time()), "hash": hashlib.sha1(reply).hexdigest()}
+            if wireBytes is not None:
+                self.__manifest["queries"][normalizeQuery(query)]["wireBytes"] = wireBytes
+            self.__manifest.get("deadLetters", {}).pop(normalizeQuery(query), None)
+            self.__dirty = True
+            self.__unsaved += 1
+
+    def recordHash(self, query, sha1):
+        """For queries cached before hashes were recorded"""
+        with self.__lock:
+            self.__manifest["queries"][normalizeQuery(query)]["hash"] = sha1
+            self.__dirty = True
+
+    def isSchemaComplete(self):
+        """True, False or None if not yet known"""
+        return None if self.__manifest["schema"] is None else self.__manifest["schema"]["complete"]
+
+    def recordSchema(self, complete, noTypes):
+        with self.__lock:
+            self.__manifest["schema"] = {"complete": complete, "types": noTypes, "recorded": int(time.time())}
+            self.__dirty = True
+
+    def describePages(self, file, limit, cstop):
+        """{"pages": , "count": } of a completed DESCRIBE of file or None"""
+        return self.__manifest["describes"].get(CacheManifest.__describeKey(file, limit, cstop))
+
+    def describesOfFile(self, file):
+        """[(limit, cstop, {"pages": , "count": })] of completed DESCRIBEs of file"""
+        describesOfFile = []
+        for key, described in self.__manifest["describes"].items():
+            match = re.match(r'(\S+) CSTOP (\S+) LIMIT (\d+)$', key)
+            if match and match.group(1) == file: # not AFTERIEN crawls
+                describesOfFile.append((int(match.group(3)), match.group(2), described))
+        return describesOfFile
+
+    def cursorCrawlsOfFile(self, file):
+        """[(limit, cstop, {"cursors": , "count": , ...})] of completed AFTERIEN crawls of file"""
+        cursorCrawls = []
+        for key, crawl in self.__manifest["describes"].items():
+            match = re.match(r'(\S+) CSTOP (\S+) LIMIT (\d+) AFTERIEN$', key)
+            if match and match.group(1) == file:
+                cursorCrawls.append((int(match.group(3)), match.group(2), crawl))
+        return cursorCrawls
+
+    def recordDescribe(self, file, limit, cstop, pages, count):
+        """Complete: the crawl's plan, if any, is done with"""
+        with self.__lock:
+            key = CacheManifest.__describeKey(file, limit, cstop)
+            self.__manifest["describes"][key] = {"pages": pages, "count": count, "recorded": int(time.time())}
+            self.__manifest["plans"].pop(key, None)
+            self.__dirty = True
+
+    def describePlan(self, file, limit, cstop):
+        """{"pages": , "count": , "planned": } of an unfinished crawl or None"""
+        return self.__manifest["plans"].get(CacheManifest.__describeKey(file, limit, cstop))
+
+    def recordDescribePlan(self, file, limit, cstop, pages, count):
+        with self.__lock:
+            self.__manifest["plans"][CacheManifest.__describeKey(file, limit, cstop)] = {"pages": pages, "count": count, "planned": int(time.time())}
+            self.__dirty = True
+
+    def pageSize(self, file, cstop):
+        """
+        Limit to page file (at cstop) with: the one chosen for it or, for
+        caches from before sizes were chosen, that of a completed DESCRIBE
+        or of any cached first page. None if never paged.
+        """
+        chosen = self.__manifest.get("pageSizes", {}).get("%s CSTOP %s" % (file, cstop))
+        if chosen:
+            return chosen["limit"]
+        limits = sorted(limit for limit, describeCStop, described in self.describesOfFile(file) if describeCStop == str(cstop))
+        if limits:
+            return limits[-1]
+        firstPage = re.compile(r'DESCRIBE %s CSTOP %s LIMIT (\d+) (?:OFFSET|AFTERIEN) 0$' % (re.escape(file), re.escape(str(cstop))))
+        limits = sorted(int(match.group(1)) for match in (firstPage.match(query) for query in self.__manifest["queries"]) if match)
+        return limits[-1] if limits else None
+
+    def pageSizeChoice(self, file, cstop):
+        """{"limit": , "bytesPerEntry": , "secondsPerEntry": , "chosen": } or None if not chosen"""
+        return self.__manifest.get("pageSizes", {}).get("%s CSTOP %s" % (file, cstop))
+
+    def recordPageSize(self, file, cstop, limit, bytesPerEntry, secondsPerEntry):
+        with self.__lock:
+            self.__manifest.setdefault("pageSizes", {})["%s CSTOP %s" % (file, cstop)] = {"limit": limit, "bytesPerEntry": bytesPerEntry, "secondsPerEntry": secondsPerEntry, "chosen": int(time.time())}
+            self.__dirty = True
+
+    def deadLetters(self):
+        return dict(self.__manifest.get("deadLetters", {}))
+
+    def clearDeadLetters(self, queries):
+        """For queries never cached as themselves ex/ batches whose files were fetched another way"""
+        with self.__lock:
+            for query in queries:
+                self.__manifest.get("deadLetters", {}).pop(normalizeQuery(query), None)
+            self.__dirty = True
+
+    def typesBatching(self):
+        """True, False or None if not yet known"""
+        return self.__manifest.get("typesBatching", {}).get("supported")
+
+    def recordTypesBatching(self, supported):
+        with self.__lock:
+            self.__manifest["typesBatching"] = {"supported": supported, "recorded": int(time.time())}
+            self.__dirty = True
+
+    def recordDeadLetter(self, query, error, attempts):
+        with self.__lock:
+            self.__manifest.setdefault("deadLetters", {})[normalizeQuery(query)] = {"error": error, "attempts": attempts, "failed": int(time.time())}
+            self.__dirty = True
+
+    def cursorCrawl(self, file, limit, cstop):
+        """
+        {"cursors": , "count": , "complete": } of an AFTERIEN crawl of file
+        or None. cursors are the IENs each page starts after ("0" first).
+        """
+        key = CacheManifest.__describeKey(file, limit, cstop) + " AFTERIEN"
+        return self.__manifest["describes"].get(key) or self.__manifest["plans"].get(key)
+
+    def recordCursorCrawl(self, file, limit, cstop, cursors, count, complete):
+        with self.__lock:
+            key = CacheManifest.__describeKey(file, limit, cstop) + " AFTERIEN"
+            crawl = {"pages": len(cursors), "cursors": list(cursors), "count": count, "complete": complete, "recorded": int(time.time())}
+            if complete:
+                self.__manifest["describes"][key] = crawl
+                self.__manifest["plans"].pop(key, None)
+            else:
+                self.__manifest["plans"][key] = crawl
+            self.__dirty = True
+            self.__unsaved += 1
+
+    def recordRefresh(self, refreshed):
+        with self.__lock:
+            self.__manifest["lastRefresh"] = refreshed
+            self.__dirty = True
+
+    def lastRefresh(self):
+        return self.__manifest.get("lastRefresh")
+
+    def reset(self):
+        """Forget everything ie/ the cache was cleared"""
+        with self.__lock:
+            self.__manifest = {"version": CacheManifest.VERSION, "queries": {}, "schema": None, "describes": {}, "plans": {}}
+            self.__dirty = True
+
+    def fingerprint(self, queryPrefixes=None):
+        """
+        Hash of what's cached - every query (or those starting with one of 
+        queryPrefixes) and, where known, its reply's size and fetch time. 
+        Changes whenever any of those queries is (re)cached.
+        """
+        with self.__lock:
+            queries = sorted(item for item in self.__manifest["queries"].items() if not queryPrefixes or item[0].startswith(tuple(queryPrefixes)))
+        sha = hashlib.sha1()
+        for query, info in queries:
+            sha.update("%s|%s|%s\n" % (query.encode("utf-8"), info.get("bytes", ""), info.get("fetched", "")))
+        return sha.hexdigest()
+
+    def save(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__store.putMeta("manifest", json.dumps(self.__manifest))
+            self.__dirty = False
+            self.__unsaved = 0
+
+    def checkpoint(self):
+        """Save if enough has been recorded since the last save"""
+        if self.__unsaved >= CacheManifest.CHECKPOINT_EVERY:
+            self.save()
+
+    @staticmethod
+    def __describeKey(file, limit, cstop):
+        return "%s CSTOP %s LIMIT %d" % (file, cstop, limit)
+
+STORE_TYPES = {"DIR": DirectoryCacheStore, "SQLITE": SQLiteCacheStore, "BLOB": BlobCacheStore, "ZIP": ZipCacheStore}
+
+def makeCacheStore(cacheLocation, storeType=None, compression=None):
+    """
+    Store for a VistA's cache directory. If no type is given then a
+    migrated (SQLite or Blob) cache is used if present, otherwise the directory.
+    If there is no directory but there is a zip of it, that is read in place.
+
+    If no compression is given then the store keeps what it was last set to.
+    """
+    if not storeType:
+        if os.path.isfile(os.path.join(cacheLocation, SQLiteCacheStore.DB_FILE)):
+            storeType = "SQLITE"
+        elif os.path.isfile(os.path.join(cacheLocation, BlobCacheStore.INDEX_FILE)):
+            storeType = "BLOB"
+        elif not os.path.exists(cacheLocation) and os.path.isfile(cacheLocation + ".zip"):
+            storeType = "ZIP"
+        else:
+            storeType = "DIR"
+    if storeType not in STORE_TYPES:
+        raise ValueError("Unknown cache store type %s" % storeType)
+    if compression and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression %s" % compression)
+    store = STORE_TYPES[storeType](cacheLocation, compression)
+    if storeType != "ZIP":
+        if compression:
+            store.putMeta("compression", compression)
+        else:
+            store.compression = store.getMeta("compression") or None
+    return store
+
+def compressCacheStore(store, compression, batchSize=500):
+    """
+    (Re)write every reply of a store with a compression. Returns the number
+    of replies rewritten.
+    """
+    store.compression = compression
+    store.putMeta("compression", compression or "")
+    noRewritten = migrateCacheStore(store, store, batchSize)
+    if isinstance(store, SQLiteCacheStore):
+        store.vacuum()
+    return noRewritten
+
+def migrateCacheStore(fromStore, toStore, batchSize=500):
+    """
+    Copy every reply of one store into another, a batch at a time. Returns
+    the number of replies copied.
+    """
+    queries = sorted(fromStore.queries())
+    for i in range(0, len(queries), batchSize):
+        toStore.putMany(fromStore.getMany(queries[i:i + batchSize]).items())
+        logging.info("Migrated %d of %d replies from %s to %s" % (min(i + batchSize, len(queries)), len(queries), fromStore, toStore))
+    return len(queries)
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'\s*')
+
+def iterReplyResults(reply, chunkSize=65536, raw=False):
+    """
+    Generator of the entries of a reply's "results", each yielded as soon as
+    it is decoded. The reply is a file-like object (a cached reply opened 
+    from a store or a network reply) or a string. Only the entry being 
+    decoded is held so memory goes with the biggest entry, not the page.
+
+    With raw, each entry is yielded as its JSON, exactly as in the reply.
+
+    Other top level fields are skipped. Reading stops at the end of "results".
+    """
+    if isinstance(reply, basestring):
+        reply = StringIO.StringIO(reply)
+    reader = _ReplyReader(reply, chunkSize)
+    reader.expect("{")
+    while True:
+        if reader.peek() == "}":
+            return
+        key = reader.value()
+        reader.expect(":")
+        if key != "results":
+            reader.value()
+            if reader.peek() == ",":
+                reader.expect(",")
+            continue
+        reader.expect("[")
+        if reader.peek() == "]":
+            return
+        while True:
+            yield reader.value(raw)
+            if reader.peek() == "]":
+                return
+            reader.expect(",")
+
+class _ReplyReader(object):
+    """
+    Buffered JSON value reader for iterReplyResults. A value that runs past
+    the buffer's end fails to decode so more is read and decoding retried.
+    Reads grow with the buffer so a huge entry isn't decoded over and over.
+    """
+    def __init__(self, replyFile, chunkSize):
+        self.__file = replyFile
+        self.__chunkSize = chunkSize
+        self.__buffer = ""
+        self.__idx = 0
+        self.__eof = False
+
+    def peek(self):
+        """Next non whitespace character"""
+        while True:
+            match = _WHITESPACE.match(self.__buffer, self.__idx)
+            self.__idx = match.end()
+            if self.__idx < len(self.__buffer):
+                return self.__buffer[self.__idx]
+            if not self.__more():
+                raise ValueError("Reply ended unexpectedly")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '%s' in reply but got '%s'" % (char, self.__buffer[self.__idx]))
+        self.__idx += 1
+
+    def value(self, raw=False):
+        """Next value, decoded or, with raw, as its JSON"""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.__buffer, self.__idx)
+            except ValueError:
+                if not self.__more():
+                    raise
+                continue
+            # a number (say) ending at the buffer's end may go on
+            if end == len(self.__buffer) and self.__more():
+                continue
+            if raw:
+                value = self.__buffer[self.__idx:end]
+            self.__idx = end
+            return value
+
+    def __more(self):
+        if self.__eof:
+            return False
+        # drop what's consumed
+        self.__buffer = self.__buffer[self.__idx:]
+        self.__idx = 0
+        chunk = self.__file.read(max(self.__chunkSize, len(self.__buffer)))
+        if not chunk:
+            self.__eof = True
+            return False
+        self.__buffer += chunk
+        return True
+
+# ######################## Migration Tool ##########################
+
+def main():
+    """
+    - migrate: move a directory cache into SQLite (or with -t BLOB, into
+    shared blobs). With --remove, the migrated files are deleted. With -c,
+    the migrated replies are compressed.
+    - compress: compress a cache (directory, SQLite or blobs) in place with -c
+    - collect: remove the blobs no VistA of a Caches directory refers to
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    opts, args = getopt.getopt(sys.argv[1:], "c:t:", ["remove"])
+    opts = dict(opts)
+    compression = opts.get("-c")
+    storeType = opts.get("-t", "SQLITE")
+    if len(args) != 2 or args[0] not in ["migrate", "compress", "collect"] or (args[0] == "compress" and not compression) or storeType not in ["SQLITE", "BLOB"]:
+        print "Enter migrate [--remove] [-t SQLITE|BLOB] [-c zlib|gzip|bz2] <cacheLocation>, compress -c zlib|gzip|bz2 <cacheLocation> ex/ Caches/VAVISTA or collect <cachesLocation> ex/ Caches"
+        return
+    if args[0] == "collect":
+        print "Removed %d unreferenced blobs from %s" % (collectBlobs(args[1]), os.path.join(args[1], BlobCacheStore.BLOBS_DIR))
+        return
+    if args[0] == "compress":
+        store = makeCacheStore(args[1])
+        noCompressed = compressCacheStore(store, compression)
+        store.close()
+        print "Compressed %d replies in %s with %s" % (noCompressed, store, compression)
+        return
+    dirStore = makeCacheStore(args[1], "DIR")
+    toStore = makeCacheStore(args[1], storeType, compression)
+    noMigrated = migrateCacheStore(dirStore, toStore)
+    toStore.close()
+    print "Migrated %d replies into %s" % (noMigrated, toStore)
+    if "--remove" in opts:
+        for query in dirStore.queries():
+            dirStore.remove(query)
+
+if __name__ == "__main__":
+    main()
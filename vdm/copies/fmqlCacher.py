@@ -7,19 +7,23 @@
 #
 
 """
-Module for managing a Cache of FMQL responses. Responses can come from a full RESTful FMQL endpoint or directly from an FMQL RPC. Caches for named VistAs are managed in a named "cacheLocation" directory.
+Module for managing a Cache of FMQL responses. Responses can come from a full RESTful FMQL endpoint or directly from an FMQL RPC. Caches for named VistAs are managed in a named "cacheLocation" directory. How a VistA's replies are stored there is up to its "store" (see fmqlCacheStores): one file per reply or a single SQLite file.
+
+Decoded replies are also kept in memory, in one size bounded LRU (REPLY_CACHE) shared by every FMQLCacher in the process. A second consumer of the same VistA's schema or file entries gets them without going back to disk and the JSON decoder.
+
+Identical queries sent at once, whether through one FMQLCacher or many, go to the VistA once: the first caller sends it and the others wait for its reply (IN_FLIGHT). This holds for query() and COUNT and, separately, for crawls: a page or type another crawl of the VistA is fetching is taken from its cache once in.
+
+Queries not cached are fetched by a FMQLCacher's FetchPool: poolSize fetcher threads, kept for every crawl, so no more queries are in flight than the RPC (or HTTP keep-alive) pool has connections. Close a FMQLCacher when done with it to stop them.
 
 TODO - Changes/Additions Planned:
-- exceptions in thread:
-  except: sys.exit()
-  and may need to put threads into an array to keep around (check 25 pool again)
 - option to filter out (ex/ redundancies in builds etc.): can choose what to cache
   - yes/no -> TRUE FALSE ie/ boolean as standard 
   - apply default if field missing
   ... or add these first to Describe flattener
+- refresh assumes Builds and Installs are only ever added (new IENs at the end). Deletions force a full recrawl of a file.
 - uri level in flatten describe including keeping label ...
 - < 1.1 check for Schema once FOIA GOLD has it
-- support read/write from ZIPs
+- support writing to ZIPs (reading is supported)
 - /usr/share/vdm/cache and the equivalent on windows (will allow setting)
 - remove support for many Vistas at once ie/ many labels ie/ one Cacher per VistA
 - support Application Proxy mechanism once added to brokerRPC
@@ -29,15 +33,153 @@ import os
 import re
 import urllib
 import urllib2
+import urlparse
 import threading
 import Queue
 import time
 import json
+import hashlib
 import sys
+import math
 import logging
+from collections import OrderedDict, defaultdict
 from brokerRPC import RPCConnectionPool        
+from fmqlHTTPPool import HTTPConnectionPool
+from fmqlCacheStores import makeCacheStore, CacheManifest, iterReplyResults, normalizeQuery
+from fmqlAsyncFetch import AsyncFetchPool
+from fmqlConcurrency import AdaptiveConcurrency, RetryPolicy, CrawlSummary
 
-__all__ = ['FMQLCacher']
+__all__ = ['FMQLCacher', 'FetchPool', 'CrawlIncomplete', 'REPLY_CACHE']
+
+class ReplyLRU(object):
+    """
+    Size bounded, thread-safe LRU of decoded replies (and, kept apart, of 
+    the results of reply pages) keyed by VistA (its cache location) and 
+    query. Sizes are of the replies' JSON. Writing a query to a cache 
+    invalidates both here.
+
+    Values are shared between consumers so treat them as read-only.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__noBytes = 0
+        
+    @property
+    def maxEntryBytes(self):
+        """Bigger replies aren't kept - they'd push out too much"""
+        return self.maxBytes / 8
+        
+    def get(self, vistaKey, query, results=False):
+        """results: the results list of a page rather than its decoded reply"""
+        key = (vistaKey, query, results)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            value, noBytes = self.__entries.pop(key)
+            self.__entries[key] = value, noBytes
+            return value
+            
+    def put(self, vistaKey, query, value, noBytes, results=False):
+        if noBytes > self.maxEntryBytes:
+            return
+        key = (vistaKey, query, results)
+        with self.__lock:
+            self.__remove(key)
+            self.__entries[key] = value, noBytes
+            self.__noBytes += noBytes
+            while self.__noBytes > self.maxBytes:
+                self.__remove(next(iter(self.__entries)))
+                
+    def invalidate(self, vistaKey, query):
+        with self.__lock:
+            self.__remove((vistaKey, query, False))
+            self.__remove((vistaKey, query, True))
+            
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__noBytes = 0
+            
+    def __remove(self, key):
+        if key in self.__entries:
+            self.__noBytes -= self.__entries.pop(key)[1]
+            
+REPLY_CACHE = ReplyLRU(64 * 1024 * 1024)
+
+class SingleFlight(object):
+    """
+    Coalesces identical calls in flight: the first caller of a key makes
+    the call and any caller of the same key while it is under way waits
+    for and shares its result (or exception) rather than making it again.
+    
+    As with REPLY_CACHE, shared results are read-only.
+    
+    For callers that can't block on each call (a crawl's many queries), lead
+    a key, land it with its result when done and wait on others' flights.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        
+    def do(self, key, call):
+        flight = self.lead(key)
+        if flight is not None:
+            return self.wait(flight)
+        try:
+            result = call()
+        except:
+            self.land(key, excInfo=sys.exc_info())
+            raise
+        self.land(key, result)
+        return result
+        
+    def lead(self, key):
+        """None if the caller now leads key (and must land it) or the flight under way"""
+        with self.__lock:
+            if key in self.__calls:
+                return self.__calls[key]
+            self.__calls[key] = {"done": threading.Event()}
+            return None
+            
+    def land(self, key, result=None, excInfo=None):
+        with self.__lock:
+            flight = self.__calls.pop(key)
+        flight["result"] = result
+        if excInfo:
+            flight["excInfo"] = excInfo
+        flight["done"].set()
+        
+    @staticmethod
+    def wait(flight):
+        while not flight["done"].is_set():
+            flight["done"].wait(60) # timeout keeps the wait interruptible (Ctrl-C)
+        if "excInfo" in flight:
+            raise flight["excInfo"][0], flight["excInfo"][1], flight["excInfo"][2]
+        return flight["result"]
+            
+# Queries in flight, keyed by VistA (its cache location) and query
+IN_FLIGHT = SingleFlight()
+
+class CrawlIncomplete(Exception):
+    """
+    A crawl ended with queries that failed every retry. What was fetched is
+    cached and a rerun fetches only what's missing.
+    """
+    def __init__(self, vistaLabel, summary):
+        Exception.__init__(self, "%s: %d queries couldn't be cached - rerun to fetch just them\n%s" % (vistaLabel, len(summary.deadLetters), summary))
+        self.summary = summary
+
+class _CountingFile(object):
+    """Counts the bytes read through it"""
+    def __init__(self, replyFile):
+        self.__file = replyFile
+        self.noBytes = 0
+    def read(self, size=-1):
+        data = self.__file.read(size)
+        self.noBytes += len(data)
+        return data
 
 class FMQLCacher:
     """
@@ -47,7 +189,16 @@ class FMQLCacher:
     - Break out iterators explicitly. They can take FMQLInterface which
     can hide the Cache as well as RPC vs FMQL EP.
     """
-    def __init__(self, cachesLocation):
+    # How failed queries of a crawl are retried
+    RETRY_POLICY = RetryPolicy()
+    
+    def __init__(self, cachesLocation, storeType=None, compression=None):
+        """
+        @param storeType: "DIR" or "SQLITE". Default is to use whatever a
+        VistA's cache already has, a directory if it is new.
+        @param compression: "zlib", "gzip" or "bz2" for replies cached from
+        now on. Default is whatever a VistA's cache was last set to.
+        """
         try:
             if not os.path.exists(cachesLocation):
                 os.mkdir(cachesLocation) 
@@ -55,6 +206,9 @@ class FMQLCacher:
             logging.critical(sys.exc_info()[0])
             raise
         self.__cachesLocation = cachesLocation
+        self.__storeType = storeType
+        self.__compression = compression
+        self.__fetchPoolLock = threading.Lock()
             
     """
     Pool size play (Schema Grab):
@@ -69,22 +223,341 @@ class FMQLCacher:
       - Elapsed Time to cache schema in 15 pieces: 134.057111025
       - Elapsed Time to cache schema in 20 pieces: 133.793686867 ie/ marginal
     For now, setting sweet spot to 15. Need to tweek for different boxes.
+    
+    No more hand tweaking: poolSize is now the most queries in flight and a
+    crawl starts at minPoolSize, going up while throughput rises and backing
+    off when latency grows or errors appear (see fmqlConcurrency). Set both
+    the same to fix it.
+    
+    With asyncFetch, an (http) fmqlEP is crawled on an event loop (see
+    fmqlAsyncFetch) with up to poolSize queries in flight. Defaults to many
+    more than threads (AsyncFetchPool.MAX_PER_HOST). An https fmqlEP is
+    crawled with threads as the event loop doesn't speak TLS.
+    
+    Crawling many VistAs at once, give every one's Cacher the same budget
+    (CrawlBudget) to cap the queries in flight across all of them.
+    
+    Crawling a VistA in clinical use, a loadShaper (LoadShaper) caps the
+    queries and bytes a second, at set times of day, and slows a crawl
+    down when the VistA's replies do.
     """
-    def setVista(self, vistaLabel, fmqlEP="", host="", port=-1, access="", verify="", poolSize=15):
+    def setVista(self, vistaLabel, fmqlEP="", host="", port=-1, access="", verify="", poolSize=None, asyncFetch=False, minPoolSize=2, budget=None, loadShaper=None):
+        self.close() # fetchers and connections of any VistA set before
         self.vistaLabel = vistaLabel
         try:
             self.__cacheLocation = self.__cachesLocation + "/" + re.sub(r' ', '_', vistaLabel)
-            if not os.path.exists(self.__cacheLocation):
-                os.mkdir(self.__cacheLocation)
+            # store makes the VistA's directory if it needs one
+            self.__store = makeCacheStore(self.__cacheLocation, self.__storeType, self.__compression)
+            self.__manifest = CacheManifest(self.__store)
+            self.__vistaKey = os.path.abspath(self.__cacheLocation)
         except:
             logging.critical(sys.exc_info()[0])
             raise
-        rpcCPool = RPCConnectionPool("VistA", poolSize, host, port, access, verify, "CG FMQL QP USER", RPCLogger()) if host else None
-        self.__poolSize = poolSize # if rpc then # threads == conn pool size
-        self.__fmqlIF = FMQLInterface(fmqlEP, rpcCPool) if (fmqlEP or rpcCPool) else None         
+        if asyncFetch and not fmqlEP:
+            raise ValueError("Async fetch needs an FMQL endpoint - %s has none" % vistaLabel)
+        if asyncFetch and urlparse.urlparse(fmqlEP).scheme != "http":
+            logging.info("%s: async fetch is http only - crawling %s with fetcher threads" % (vistaLabel, fmqlEP))
+            asyncFetch = False
+        self.__asyncFetch = asyncFetch
+        self.__poolSize = poolSize or (AsyncFetchPool.MAX_PER_HOST if asyncFetch else 15) # if rpc then # threads == conn pool size
+        self.__minPoolSize = min(minPoolSize, self.__poolSize)
+        self.__budget = budget
+        self.__loadShaper = loadShaper
+        rpcCPool = RPCConnectionPool("VistA", self.__poolSize, host, port, access, verify, "CG FMQL QP USER", RPCLogger()) if host else None
+        httpCPool = HTTPConnectionPool(fmqlEP, self.__poolSize) if (fmqlEP and not rpcCPool) else None
+        self.__fmqlIF = FMQLInterface(fmqlEP, rpcCPool, httpCPool) if (fmqlEP or rpcCPool) else None         
+        
+    def close(self):
+        """Stop this Cacher's fetchers and close their connections. A later crawl starts them again."""
+        with self.__fetchPoolLock:
+            if getattr(self, "_FMQLCacher__fetchPool", None):
+                self.__fetchPool.close()
+            self.__fetchPool = None
+        httpCPool = getattr(getattr(self, "_FMQLCacher__fmqlIF", None), "httpCPool", None) # not of a stand in
+        if httpCPool:
+            httpCPool.close()
+    
+    @property
+    def cacheLocation(self):
+        return self.__cacheLocation
+        
+    @property
+    def canFetch(self):
+        """Has an FMQL endpoint or RPC to fetch what isn't cached"""
+        return self.__fmqlIF is not None
+        
+    def isFileCached(self, file, cstop=100):
+        """
+        Every entry of file is cached at cstop (a completed DESCRIBE, paged
+        with whatever limit) so describeFileEntries needn't fetch any.
+        """
+        limit = self.__manifest.pageSize(file, cstop)
+        return bool(limit) and self.__isDescribeCached(file, limit, cstop)
+        
+    def fingerprint(self, queryPrefixes=None):
+        """
+        Changes whenever anything in this VistA's cache changes or, with
+        queryPrefixes, whenever any query starting with them changes
+        ex/ ["DESCRIBE 9_6 "] for Builds.
+        """
+        return self.__manifest.fingerprint(queryPrefixes)
+        
+    def replyHash(self, query):
+        """
+        sha1 of a cached reply or None if it isn't cached. Replies with the
+        same hash are identical, in this or any other VistA's cache.
+        """
+        queryInfo = self.__manifest.queryInfo(query)
+        if queryInfo is None:
+            return None
+        if "hash" not in queryInfo:
+            reply = self.__store.get(query)
+            if reply is None:
+                return None
+            self.__manifest.recordHash(query, hashlib.sha1(reply).hexdigest())
+            self.__manifest.checkpoint()
+            queryInfo = self.__manifest.queryInfo(query)
+        return queryInfo["hash"]
     
     def clearCache(self, vistaLabel):
-        pass
+        """Remove every cached reply of this (the set) VistA"""
+        if vistaLabel != self.vistaLabel:
+            raise Exception("Cacher is set to VistA %s - can't clear %s" % (self.vistaLabel, vistaLabel))
+        for query in self.__store.queries():
+            self.__store.remove(query)
+            REPLY_CACHE.invalidate(self.__vistaKey, query)
+        self.__manifest.reset()
+        self.__manifest.save()
+        
+    def refresh(self):
+        """
+        Bring a cached VistA up to date from its Install (9.7) history
+        rather than recaching it all:
+        - new Install and Build entries: only the pages from the last cached 
+        (partial) page on are refetched, for every limit/cstop cached. An
+        AFTERIEN crawl goes on from its last page's cursor.
+        - builds installed since: the schema of the files in their 'file' 
+        cnodes (and those files' subfiles) is refetched, along with SELECT
+        TYPES and any new file.
+        
+        Returns the names of the builds installed since the last refresh
+        (or crawl).
+        """
+        if not self.__fmqlIF:
+            raise Exception("Can't refresh %s - no FMQL endpoint or RPC set" % self.vistaLabel)
+        start = int(time.time())
+        newInstalls = []
+        for file in ["9_7", "9_6"]:
+            describesOfFile = self.__manifest.describesOfFile(file)
+            cursorCrawls = self.__manifest.cursorCrawlsOfFile(file)
+            if not (describesOfFile or cursorCrawls):
+                continue
+            total = self.__count(file)
+            for limit, cstop, described in describesOfFile:
+                if total == described["count"]:
+                    continue
+                if total < described["count"]:
+                    logging.info("%s: entries removed from %s - refetching all of it" % (self.vistaLabel, file))
+                    firstPage = 0
+                else:
+                    firstPage = described["count"] / limit # last cached page is partial
+                goes = total/limit + 1
+                loqueries = [FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, page * limit) for page in range(firstPage, goes)]
+                self.__fetchQueries(loqueries)
+                if not self.__allFetchedSince(loqueries, start):
+                    raise Exception("Failed to refresh all of %s (limit %d, cstop %s) - exiting" % (file, limit, cstop))
+                self.__manifest.recordDescribe(file, limit, cstop, goes, total)
+                # the installs added, from the first refetched page's results
+                if file == "9_7" and not newInstalls and described["count"] < total:
+                    skip = described["count"] - firstPage * limit
+                    for loquery in loqueries:
+                        for result in self.__cachedResults(loquery):
+                            if skip:
+                                skip -= 1
+                                continue
+                            newInstalls.append(result)
+            for limit, cstop, crawl in cursorCrawls:
+                if total == crawl["count"]:
+                    continue
+                added = self.__refreshCursorCrawl(file, limit, cstop, crawl, total, start)
+                if file == "9_7" and not newInstalls:
+                    newInstalls = added
+        self.__manifest.save()
+        buildNames = set(install["name"]["value"] for install in newInstalls if "name" in install)
+        if newInstalls:
+            self.__refreshSchema(self.__filesOfBuilds(buildNames), start)
+        self.__manifest.recordRefresh({"refreshed": start, "installs": len(newInstalls), "builds": sorted(buildNames)})
+        self.__manifest.save()
+        logging.info("%s: refreshed - %d new installs of %d builds" % (self.vistaLabel, len(newInstalls), len(buildNames)))
+        return sorted(buildNames)
+        
+    def __refreshCursorCrawl(self, file, limit, cstop, crawl, total, start):
+        """
+        Refetch an AFTERIEN crawl from its last (partial) page, following
+        cursors until a page is short, or from the start if entries were 
+        removed. Returns the entries after those it had.
+        """
+        if total < crawl["count"]:
+            logging.info("%s: entries removed from %s - refetching all of it" % (self.vistaLabel, file))
+            cursors, count, skip = ["0"], 0, None
+        else:
+            cursors = crawl["cursors"]
+            count = crawl["count"] - len(json.loads(self.__store.get(FMQLCacher.AFTERIEN_TEMPL % (file, cstop, limit, cursors[-1])))["results"])
+            skip = crawl["count"] - count
+        added = []
+        while True:
+            loquery = FMQLCacher.AFTERIEN_TEMPL % (file, cstop, limit, cursors[-1])
+            self.__fetchQueries([loquery])
+            if not self.__allFetchedSince([loquery], start):
+                raise Exception("Failed to refresh all of %s (limit %d, cstop %s, after %s) - exiting" % (file, limit, cstop, cursors[-1]))
+            results = json.loads(self.__store.get(loquery))["results"]
+            count += len(results)
+            if skip is not None:
+                added.extend(results[skip:])
+                skip = 0
+            if len(results) < limit:
+                break
+            cursors = cursors + [results[-1]["uri"]["value"].split("-")[1]]
+        self.__manifest.recordCursorCrawl(file, limit, cstop, cursors, count, True)
+        return added
+        
+    def __filesOfBuilds(self, buildNames):
+        """
+        Files (_ form) in the 'file' cnodes of builds. Builds are found in
+        the deepest cached 9_6 pages. Paged in full (CSTOP 10000), their
+        cnodes are there. Paged shallow (CSTOP 0, as when indexed against a
+        baseline), each is described on its own (describeEntries).
+        """
+        files = set()
+        describesOfBuilds = sorted(self.__manifest.describesOfFile("9_6"), key=lambda describe: int(describe[1]))
+        if not (buildNames and describesOfBuilds):
+            return files
+        limit, cstop, described = describesOfBuilds[-1]
+        buildResults = []
+        for page in range(described["pages"]):
+            for result in self.__cachedResults(FMQLCacher.DESCRIBE_TEMPL % ("9_6", cstop, limit, page * limit)):
+                if "name" in result and result["name"]["value"] in buildNames:
+                    buildResults.append(result)
+        if int(cstop) < 10000:
+            buildResults = self.describeEntries("9_6", [result["uri"]["value"].split("-")[1] for result in buildResults], cstop=10000)
+        for buildResult in buildResults:
+            for fileAbout in FMQLDescribeResult(buildResult).cnodes("file") or []:
+                if "file" in fileAbout:
+                    files.add(re.sub(r'\.', '_', fileAbout["file"][2:]))
+        return files
+        
+    def __refreshSchema(self, files, start):
+        """Refetch SELECT TYPES, the DESCRIBE TYPE of files and of their subfiles and of any new file"""
+        if not self.__manifest.isSchemaComplete():
+            return
+        self.__fetchQueries(["SELECT TYPES"])
+        if not self.__allFetchedSince(["SELECT TYPES"], start):
+            raise Exception("Failed to refresh SELECT TYPES of %s - exiting" % self.vistaLabel)
+        REPLY_CACHE.invalidate(self.__vistaKey, "SELECT TYPES")
+        results = [result for result in self.query("SELECT TYPES")["results"] if float(result["number"]) >= 1.1]
+        # subfiles (SELECT TYPES gives "parent"): keep going until no more added
+        while True:
+            subFiles = set(re.sub(r'\.', '_', result["number"]) for result in results if "parent" in result and re.sub(r'\.', '_', result["parent"]) in files)
+            if subFiles.issubset(files):
+                break
+            files.update(subFiles)
+        loqueries = ["DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) for result in results]
+        loqueries = [loquery for loquery in loqueries if loquery[len("DESCRIBE TYPE "):] in files or not self.__manifest.isCached(loquery)]
+        self.__fetchTypes(self.__byExpectedCost(loqueries, results))
+        self.__checkSchemaCached()
+        self.__manifest.save()
+        
+    def __fetchQueries(self, queries, onCached=None):
+        """
+        (Re)fetch and cache queries with the pool's fetchers. onCached(query) 
+        as each is cached.
+        
+        A query another crawl of the VistA (by this Cacher or another) is
+        already fetching isn't sent again: its reply is cached from that
+        crawl's store once in or, if that crawl couldn't get it, fetched here.
+        """
+        uncached = set(query for query in queries if not self.__manifest.isCached(query))
+        crawlKey = lambda query: (self.__vistaKey, normalizeQuery(query), "crawl")
+        ownQueries = []
+        othersFlights = OrderedDict()
+        for query in queries:
+            flight = IN_FLIGHT.lead(crawlKey(query))
+            if flight is not None:
+                othersFlights[query] = flight
+            # cached by a flight that landed since it was asked for (a cached
+            # one asked for is a refetch ex/ refresh)
+            elif query in uncached and self.__manifest.isCached(query):
+                IN_FLIGHT.land(crawlKey(query), (self.__store, self.__manifest))
+                if onCached:
+                    onCached(query)
+            else:
+                ownQueries.append(query)
+        landed = set()
+        def onOwnCached(query):
+            landed.add(query)
+            IN_FLIGHT.land(crawlKey(query), (self.__store, self.__manifest))
+            if onCached:
+                onCached(query)
+        try:
+            self.__fetchOwnQueries(ownQueries, onOwnCached)
+        finally:
+            # ones that failed: others waiting fetch them themselves
+            for query in ownQueries:
+                if query not in landed:
+                    IN_FLIGHT.land(crawlKey(query))
+        refetch = []
+        for query, flight in othersFlights.items():
+            othersCache = IN_FLIGHT.wait(flight)
+            if othersCache and othersCache[0] is self.__store:
+                if onCached:
+                    onCached(query)
+                continue
+            reply = othersCache[0].get(query) if othersCache else None
+            if reply is None or not cacheReply(self.__store, self.__manifest, query, reply, (othersCache[1].queryInfo(query) or {}).get("wireBytes")):
+                refetch.append(query) # not cached there (ex/ a batch) or that crawl failed
+            elif onCached:
+                onCached(query)
+        if refetch:
+            self.__fetchQueries(refetch, onCached)
+        
+    def __fetchOwnQueries(self, queries, onCached):
+        if not queries:
+            return
+        with self.__fetchPoolLock: # _Arrivals readers may get here at once
+            if not self.__fetchPool:
+                if self.__asyncFetch:
+                    store, manifest = self.__store, self.__manifest
+                    self.__fetchPool = AsyncFetchPool(self.__fmqlIF.fmqlEP, lambda query, reply, wireBytes: cacheReply(store, manifest, query, reply, wireBytes), self.__poolSize, self.__minPoolSize, self.vistaLabel, FMQLCacher.RETRY_POLICY, self.__budget, self.__loadShaper)
+                else:
+                    self.__fetchPool = FetchPool(self.__fmqlIF, self.__store, self.__manifest, self.__poolSize, self.__minPoolSize, self.vistaLabel, FMQLCacher.RETRY_POLICY, self.__budget, self.__loadShaper)
+            fetchPool = self.__fetchPool
+        summary = fetchPool.fetch(queries, onCached)
+        for query, (error, attempts) in summary.deadLetters.items():
+            self.__manifest.recordDeadLetter(query, error, attempts)
+        self.__manifest.save()
+        if len(queries) > 1 or summary.noRetries or summary.deadLetters:
+            logging.info("%s: crawl done - %s" % (self.vistaLabel, summary))
+        if summary.deadLetters:
+            raise CrawlIncomplete(self.vistaLabel, summary)
+        
+    def deadLetters(self):
+        """
+        Queries that failed every retry of a crawl and are still uncached:
+        {query: {"error": , "attempts": , "failed": }}. Each is fetched 
+        again when its crawl is rerun.
+        """
+        return self.__manifest.deadLetters()
+        
+    def __cachedResults(self, loquery):
+        replyFile = self.__store.open(loquery)
+        try:
+            for result in iterReplyResults(replyFile):
+                yield result
+        finally:
+            replyFile.close()
+        
+    def __allFetchedSince(self, queries, since):
+        return all((self.__manifest.queryInfo(query) or {}).get("fetched", 0) >= since for query in queries)
         
     def query(self, query):
         """
@@ -92,17 +565,39 @@ class FMQLCacher:
         the reply. 
         
         Simple, blocking invocation. No generator, iterator or threading
-        efficiencies.
+        efficiencies. If the same query is already being sent (by any
+        Cacher of this VistA) then its reply is waited for and shared. 
+        Failures are retried as a crawl's are.
         """
-        queryFile = self.__cacheLocation + "/" + query + ".json"
-        if os.path.isfile(queryFile):
-            reply = json.load(open(queryFile, "r"))
-            return reply
-        reply = self.__fmqlIF.query(query)
+        jreply = self.__cachedReply(query)
+        if jreply is not None:
+            return jreply
+        def queryOnce():
+            # cached by a flight that landed since
+            jreply = self.__cachedReply(query)
+            return self.__queryAndCache(query) if jreply is None else jreply
+        return IN_FLIGHT.do((self.__vistaKey, normalizeQuery(query)), queryOnce)
+        
+    def __cachedReply(self, query):
+        if self.__manifest.isCached(query):
+            jreply = REPLY_CACHE.get(self.__vistaKey, query)
+            if jreply is not None:
+                return jreply
+            reply = self.__store.get(query)
+            if reply is not None:
+                jreply = json.loads(reply)
+                REPLY_CACHE.put(self.__vistaKey, query, jreply, len(reply))
+                return jreply
+        return None
+        
+    def __queryAndCache(self, query):
+        transfer = {}
+        reply = self.__send(query, transfer)
         jreply = json.loads(reply)
-        jcache = open(self.__cacheLocation + "/" + query + ".json", "w")
-        json.dump(jreply, jcache)
-        jcache.close()
+        self.__store.put(query, reply)
+        REPLY_CACHE.invalidate(self.__vistaKey, query)
+        self.__manifest.recordQuery(query, reply, transfer.get("wireBytes"))
+        self.__manifest.save()
         # logging.info("Cached " + query)
         return jreply
                     
@@ -120,127 +615,542 @@ class FMQLCacher:
         All this should move out of the Cacher class.
         - flatten field and file description ie/ remove "value"
         """
-        if not self.__isSchemaCached():
-            self.__cacheSchema()
-        queryFile = self.__cacheLocation + "/SELECT TYPES.json"
-        selectTypesReply = json.load(open(queryFile))
-        for result in selectTypesReply["results"]:
-            if float(result["number"]) < 1.1: 
-                continue # TEMP - ignore under 1.1
-            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) + ".json"
-            if not os.path.isfile(queryFile):
-                raise Exception("Expected Schema for %s to be in Cache but it wasn't - exiting" % result["number"])
-            jreply = json.load(open(queryFile))
-            if "count" in result:
-                jreply["count"] = result["count"]
-            yield jreply
+        arrivals = None if self.__isSchemaCached() else self.__cacheSchema()
+        results = [result for result in self.query("SELECT TYPES")["results"] if float(result["number"]) >= 1.1] # TEMP - ignore under 1.1
+        # Read the descriptions not in memory in bulk, a batch at a time
+        for i in range(0, len(results), FMQLCacher.__SCHEMA_BATCH):
+            batch = results[i:i + FMQLCacher.__SCHEMA_BATCH]
+            if arrivals: # a batch is read once all of it is in
+                for result in batch:
+                    arrivals.waitFor("DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]))
+            jreplies = {}
+            for result in batch:
+                query = "DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"])
+                jreply = REPLY_CACHE.get(self.__vistaKey, query)
+                if jreply is not None:
+                    jreplies[query] = jreply
+            missingQueries = [typeQuery for typeQuery in ("DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) for result in batch) if typeQuery not in jreplies]
+            replies = self.__store.getMany(missingQueries) if missingQueries else {}
+            for query, reply in replies.items():
+                jreplies[query] = json.loads(reply)
+                REPLY_CACHE.put(self.__vistaKey, query, jreplies[query], len(reply))
+            for result in batch:
+                query = "DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"])
+                if query not in jreplies:
+                    raise Exception("Expected Schema for %s to be in Cache but it wasn't - exiting" % result["number"])
+                jreply = jreplies[query]
+                if "count" in result:
+                    jreply = dict(jreply, count=result["count"]) # shared one is read-only
+                yield jreply
+        if arrivals:
+            arrivals.finish()
+            self.__checkSchemaCached()
+            self.__manifest.save()
+            
+    __SCHEMA_BATCH = 200
             
     def __isSchemaCached(self):
-        queryFile = self.__cacheLocation + "/SELECT TYPES.json"
-        if not os.path.isfile(queryFile):
+        """From the manifest. Caches from before manifests are checked once"""
+        complete = self.__manifest.isSchemaComplete()
+        if complete is None:
+            complete = self.__checkSchemaCached()
+            if complete:
+                self.__manifest.save()
+        return complete
+        
+    def __checkSchemaCached(self):
+        """Record (if complete) whether all of SELECT TYPES is described"""
+        if not self.__manifest.isCached("SELECT TYPES"):
             return False
-        selectTypesReply = json.load(open(queryFile))
+        selectTypesReply = json.loads(self.__store.get("SELECT TYPES"))
+        noTypes = 0
         for result in selectTypesReply["results"]:
             if float(result["number"]) < 1.1: 
                 continue # TEMP - ignore under 1.1
-            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) + ".json"
-            if not os.path.isfile(queryFile):
+            if not self.__manifest.isCached("DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"])):
                 return False
+            noTypes += 1
+        self.__manifest.recordSchema(True, noTypes)
         return True   
         
     # BAD JSON FIX: have it check if in cache as may not be? Return a list?     
         
     # Elapsed Time to cache schema in 50 pieces: 136.819022894
     def __cacheSchema(self):
+        """Start fetching the types not yet described. Returns their _Arrivals."""
         start = time.time()
         reply = self.query("SELECT TYPES")
-        queriesQueue = Queue.Queue()
-        for i in range(self.__poolSize):
-            fmqlIF = self.__fmqlIF # TODO: shared makes no speed difference (make sure)
-            t = ThreadedQueriesCacher(fmqlIF, queriesQueue, self.__cacheLocation)
-            t.setDaemon(True)
-            t.start()
         # logging.info("Caching %d types at a time" % self.__poolSize)
-        for result in reply["results"]:
-            if float(result["number"]) < 1.1: 
-                continue
-            queriesQueue.put("DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]))
-        queriesQueue.join()
+        loqueries = ["DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) for result in reply["results"] if float(result["number"]) >= 1.1]
+        return _Arrivals(self.__fetchTypes, self.__byExpectedCost([loquery for loquery in loqueries if not self.__manifest.isCached(loquery)], reply["results"]))
         # logging.info("Elapsed Time to cache schema in %d pieces: %s" % (self.__poolSize, time.time() - start))        
         
+    # Guess of a DESCRIBE TYPE's reply bytes, before it has been fetched, for
+    # a file with no subfiles or entries
+    TYPE_BYTES = 4000
+        
+    def __byExpectedCost(self, loqueries, selectTypesResults):
+        """
+        DESCRIBE TYPE queries, those expected to take longest first. In 
+        SELECT TYPES order, a few big definitions (ex/ Patient (2), the
+        subfiles of Lab (63)) could start last and stretch a crawl when the
+        rest are long done.
+        
+        Reply size is the cost: as cached before if it was (ex/ a refresh)
+        or else guessed from SELECT TYPES - a file with many subfiles has
+        many fields and one with many entries (its count) tends to be a 
+        big, much extended one.
+        """
+        noSubFiles = defaultdict(int)
+        counts = {}
+        for result in selectTypesResults:
+            if "parent" in result:
+                noSubFiles[re.sub(r'\.', '_', result["parent"])] += 1
+            if re.match(r'\d+$', result.get("count", "")):
+                counts[re.sub(r'\.', '_', result["number"])] = int(result["count"])
+        def expectedBytes(loquery):
+            # caches from before manifests have queries without sizes
+            noBytes = (self.__manifest.queryInfo(loquery) or {}).get("bytes")
+            if noBytes is not None:
+                return noBytes
+            file = loquery[len("DESCRIBE TYPE "):]
+            return FMQLCacher.TYPE_BYTES * (1 + noSubFiles[file]) * (1 + math.log10(1 + counts.get(file, 0)) / 4)
+        return sorted(loqueries, key=expectedBytes, reverse=True) # stable: ties keep their order
+        
+    # Files described by one batched query. 1 turns batching off.
+    TYPES_BATCH = 25
+    TYPES_TEMPL = "DESCRIBE TYPES %s"
+    # Files of the batch that finds out if an FMQL batches: the cheapest
+    TYPES_PROBE = 3
+        
+    def __fetchTypes(self, loqueries, onCached=None):
+        """
+        (Re)fetch DESCRIBE TYPE queries TYPES_BATCH files at a time ("DESCRIBE
+        TYPES 2,2_01,...") if the VistA's FMQL batches. A schema is thousands
+        of files and, over a high latency link, a round trip (and broker
+        overhead) each is most of the time a crawl takes.
+        
+        A batch's reply is split into the same per file entries as before
+        (see cacheReply) so readers of the cache can't tell. Files are dealt
+        out to batches, heaviest first, so each gets its share of the big
+        ones rather than the first batch taking them all.
+        
+        Whether an FMQL batches is found out with a small batch of the 
+        cheapest files (TYPES_PROBE), sent on its own, and kept in the 
+        manifest. One that doesn't, replies with an error: its files are then
+        fetched one at a time, as are any a batch left out or that failed. If
+        the probe gets no reply at all, this crawl doesn't batch and the next
+        asks again.
+        
+        onCached(query) is called with each DESCRIBE TYPE as it is cached.
+        """
+        start = int(time.time())
+        if FMQLCacher.TYPES_BATCH > 1 and len(loqueries) > 1 and self.__manifest.typesBatching() is not False:
+            batches = OrderedDict()
+            def addBatch(batch):
+                batches[FMQLCacher.TYPES_TEMPL % ",".join(loquery[len("DESCRIBE TYPE "):] for loquery in batch)] = batch
+            probing = self.__manifest.typesBatching() is None
+            rest = loqueries
+            if probing:
+                probe, rest = loqueries[-FMQLCacher.TYPES_PROBE:], loqueries[:-FMQLCacher.TYPES_PROBE]
+                addBatch(probe)
+            noBatches = int(math.ceil(len(rest) / float(FMQLCacher.TYPES_BATCH)))
+            for i in range(noBatches):
+                addBatch(rest[i::noBatches])
+            def onBatchCached(batchQuery):
+                for loquery in batches[batchQuery]:
+                    if onCached and self.__allFetchedSince([loquery], start):
+                        onCached(loquery)
+            batchQueries = batches.keys()
+            if probing:
+                try:
+                    self.__fetchQueries(batchQueries[:1], onBatchCached)
+                    batching = any(self.__allFetchedSince([loquery], start) for loquery in probe)
+                    logging.info("%s: FMQL %s batched DESCRIBE TYPES" % (self.vistaLabel, "answers" if batching else "doesn't answer"))
+                    self.__manifest.recordTypesBatching(batching)
+                    self.__manifest.save()
+                except CrawlIncomplete:
+                    batching = False # no reply (ex/ HTTP 500) says nothing of batching
+                    logging.info("%s: no reply to batched DESCRIBE TYPES - fetching types one by one" % self.vistaLabel)
+                batchQueries = batchQueries[1:] if batching else []
+            try:
+                self.__fetchQueries(batchQueries, onBatchCached)
+            except CrawlIncomplete:
+                pass # files of failed batches go one by one
+            self.__manifest.clearDeadLetters(batches.keys())
+            loqueries = [loquery for loquery in loqueries if not self.__allFetchedSince([loquery], start)]
+        self.__fetchQueries(loqueries, onCached)
+        
     DESCRIBE_TEMPL = "DESCRIBE %s CSTOP %s LIMIT %d OFFSET %d"
+    
+    # Page size: a page of a DESCRIBE aims for about this much reply and time
+    # to fetch, within PAGE_LIMITS entries. First paged with PAGE_PROBE_LIMIT.
+    PAGE_TARGET_BYTES = 1000000
+    PAGE_TARGET_SECONDS = 20.0
+    PAGE_LIMITS = (10, 1000)
+    PAGE_PROBE_LIMIT = 20
+    # A size chosen from COUNT alone (a file of no more than PAGE_PROBE_LIMIT
+    # entries) is chosen again once the file has this many times that
+    PAGE_REPROBE = 10
         
-    def describeFileEntries(self, file, limit=200, cstop=100):
+    def describeFileEntries(self, file, limit=None, cstop=100, afterIEN=False):
         """
         This is a generator object that avoids the need for every one
-        of the results of a query to be in memory for processing. 
+        of the results of a query to be in memory for processing. Each
+        page is decoded incrementally, an entry at a time. Pages small
+        enough for REPLY_CACHE are kept there for the next consumer.
                 
         Invoke with:
             for cnt, entry in enumerate(.describeFileEntries()) 
 
+        If the file isn't cached, its pages are yielded, in order, as they 
+        arrive so indexing a file overlaps fetching it. A page that fails is
+        retried. If it fails every retry then, once the rest are in, this 
+        raises CrawlIncomplete. The next call resumes the crawl, fetching only
+        the missing pages.
+        
+        With afterIEN, pages are fetched with AFTERIEN (after the last IEN of
+        the page before) rather than OFFSET. The server doesn't walk past 
+        every entry before a page to get to it so deep pages of big files 
+        (9_6, 9_7) are no slower than the first and an entry added mid-crawl
+        doesn't shift the pages after it. Pages come one after another (the
+        next is fetched while this one is read) and are cached under their
+        own "... AFTERIEN <ien>" queries.
+        
+        Leave limit out to page with the size chosen for file and cstop (see
+        __pageSize) rather than a fixed one.
+
         TODO: 
         - may make iterator/generator more explicit by returning one.
           ex/ FMQLFileIterator
-        - right now, if one fails (ie/ no cache of errored json) then will exception. Perhaps try again or more elegantly exit.
         """
-        if not self.__isDescribeCached(file, limit, cstop):
-            self.__cacheDescribe(file, limit, cstop)
-        offset = 0
-        # Ensure all wanted are in Cache. If not, recache EVERYTHING!
-        while True:
-            loquery = FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, offset)
-            queryFile = self.__cacheLocation + "/" + loquery + ".json"
-            if not os.path.isfile(queryFile):
+        if not limit:
+            limit = self.__pageSize(file, cstop, afterIEN)
+        if afterIEN:
+            for result in self.__describeFileEntriesAfterIEN(file, limit, cstop):
+                yield result
+            return
+        arrivals = None
+        if self.__isDescribeCached(file, limit, cstop):
+            pages = self.__manifest.describePages(file, limit, cstop)["pages"]
+        else:
+            pages, arrivals = self.__cacheDescribe(file, limit, cstop)
+        for page in range(pages):
+            loquery = FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, page * limit)
+            if arrivals:
+                arrivals.waitFor(loquery)
+            results = REPLY_CACHE.get(self.__vistaKey, loquery, True)
+            if results is not None:
+                for result in results:
+                    yield result
+                continue
+            replyFile = self.__store.open(loquery)
+            if replyFile is None:
                 raise Exception("Expected result of %s to be in Cache but it wasn't - exiting" % loquery)
-            reply = json.load(open(queryFile, "r"))
-            # logging.info("Reading - %s (%d results) - from cache" % (loquery, int(reply["count"])))
-            for result in reply["results"]:
+            # logging.info("Reading - %s - from cache" % loquery)
+            countingFile = _CountingFile(replyFile)
+            queryInfo = self.__manifest.queryInfo(loquery)
+            # Only hold on to a page's results if the page will be kept
+            results = None if queryInfo and queryInfo.get("bytes", 0) > REPLY_CACHE.maxEntryBytes else []
+            try:
+                for result in iterReplyResults(countingFile):
+                    if results is not None:
+                        results.append(result)
+                        if countingFile.noBytes > REPLY_CACHE.maxEntryBytes:
+                            results = None
+                    yield result
+            finally:
+                replyFile.close()
+            if results is not None:
+                REPLY_CACHE.put(self.__vistaKey, loquery, results, countingFile.noBytes, True)
+        if arrivals:
+            arrivals.finish()
+            self.__manifest.recordDescribe(file, limit, cstop, pages, self.__manifest.describePlan(file, limit, cstop)["count"])
+            self.__manifest.save()
+                    
+    AFTERIEN_TEMPL = "DESCRIBE %s CSTOP %s LIMIT %d AFTERIEN %s"
+    
+    def __pageSize(self, file, cstop, afterIEN):
+        """
+        Entries per page of file at cstop. An entry's cost varies greatly
+        with cstop and file (a build at CSTOP 10000 is many times an install
+        at CSTOP 0) so no one size suits all: too small and a crawl is many 
+        chatty queries, too big and pages time out.
+        
+        Chosen once, from COUNT and a small first page (probe): as many
+        entries as fit PAGE_TARGET_BYTES and PAGE_TARGET_SECONDS. The choice
+        is kept in the manifest so the file is always read with the limit
+        it was cached with. A cache from before sizes were chosen keeps
+        whatever limit it was paged with.
+        
+        The probe's time includes a query's fixed cost so it errs to smaller
+        pages. It isn't cached: the file's pages are cached at the chosen 
+        limit.
+        
+        A file too small to probe when first paged gets PAGE_PROBE_LIMIT. 
+        Once it is known (from a refresh) to have grown PAGE_REPROBE times
+        past that, its size is chosen again and it is paged anew with it.
+        """
+        limit = self.__manifest.pageSize(file, cstop)
+        if limit and not self.__outgrewPageSize(file, cstop, limit):
+            return limit
+        total = self.__count(file)
+        minLimit, maxLimit = FMQLCacher.PAGE_LIMITS
+        bytesPerEntry = secondsPerEntry = None
+        if total <= FMQLCacher.PAGE_PROBE_LIMIT:
+            limit = max(minLimit, FMQLCacher.PAGE_PROBE_LIMIT)
+        else:
+            probe = (FMQLCacher.AFTERIEN_TEMPL if afterIEN else FMQLCacher.DESCRIBE_TEMPL) % (file, cstop, FMQLCacher.PAGE_PROBE_LIMIT, 0)
+            # cached by crawls from before probes weren't
+            timed = not self.__manifest.isCached(probe)
+            if timed:
+                def sendProbe():
+                    start = time.time()
+                    return self.__send(probe), time.time() - start
+                reply, seconds = IN_FLIGHT.do((self.__vistaKey, probe, "uncached"), sendProbe)
+            else:
+                reply = self.__store.get(probe)
+            noEntries = max(1, int(json.loads(reply)["count"]))
+            bytesPerEntry = len(reply) / noEntries
+            limit = FMQLCacher.PAGE_TARGET_BYTES / max(1, bytesPerEntry)
+            if timed:
+                secondsPerEntry = seconds / noEntries
+                limit = min(limit, int(FMQLCacher.PAGE_TARGET_SECONDS / max(0.001, secondsPerEntry)))
+            limit = max(minLimit, min(maxLimit, limit - limit % 10))
+            logging.info("%s: paging %s (cstop %s) %d at a time - entries average %d bytes%s" % (self.vistaLabel, file, cstop, limit, bytesPerEntry, ", %.3fs" % secondsPerEntry if timed else ""))
+        self.__manifest.recordPageSize(file, cstop, limit, bytesPerEntry, secondsPerEntry)
+        if not afterIEN: # spares __cacheDescribe a second COUNT
+            self.__manifest.recordDescribePlan(file, limit, cstop, total/limit + 1, total)
+        self.__manifest.save()
+        return limit
+        
+    def __outgrewPageSize(self, file, cstop, limit):
+        """Size chosen from COUNT alone and the file since grown well past it"""
+        chosen = self.__manifest.pageSizeChoice(file, cstop)
+        if not (chosen and chosen["bytesPerEntry"] is None and self.canFetch):
+            return False
+        counts = [crawl["count"] for crawl in [self.__manifest.describePages(file, limit, cstop), self.__manifest.cursorCrawl(file, limit, cstop)] if crawl]
+        return max(counts or [0]) > FMQLCacher.PAGE_REPROBE * FMQLCacher.PAGE_PROBE_LIMIT
+    
+    def __describeFileEntriesAfterIEN(self, file, limit, cstop):
+        """
+        Page by page, each after the last IEN of the one before. The IEN each
+        page starts after is kept in the manifest so a crawl resumes from its
+        last cached page. A page that is short (< limit) is the last.
+        """
+        crawl = self.__manifest.cursorCrawl(file, limit, cstop)
+        cursors = crawl["cursors"] if crawl else ["0"]
+        complete = crawl["complete"] if crawl else False
+        total = 0
+        nextArrival = None
+        page = 0
+        while True:
+            loquery = FMQLCacher.AFTERIEN_TEMPL % (file, cstop, limit, cursors[page])
+            if nextArrival:
+                nextArrival.finish()
+            elif not self.__manifest.isCached(loquery):
+                self.__fetchQueries([loquery])
+            results = REPLY_CACHE.get(self.__vistaKey, loquery, True)
+            if results is None:
+                reply = self.__store.get(loquery)
+                if reply is None:
+                    raise Exception("Expected result of %s to be in Cache but it wasn't - exiting" % loquery)
+                results = json.loads(reply)["results"]
+                REPLY_CACHE.put(self.__vistaKey, loquery, results, len(reply), True)
+            total += len(results)
+            last = (page == len(cursors) - 1) if complete else len(results) < limit
+            nextArrival = None
+            if not last:
+                if page == len(cursors) - 1:
+                    cursors.append(results[-1]["uri"]["value"].split("-")[1])
+                    self.__manifest.recordCursorCrawl(file, limit, cstop, cursors, total, False)
+                    self.__manifest.checkpoint()
+                nextQuery = FMQLCacher.AFTERIEN_TEMPL % (file, cstop, limit, cursors[page + 1])
+                if not self.__manifest.isCached(nextQuery):
+                    nextArrival = _Arrivals(self.__fetchQueries, [nextQuery])
+            for result in results:
                 yield result
-            if int(reply["count"]) != limit:
+            if last:
                 break
-            offset += limit
+            page += 1
+        if not complete:
+            self.__manifest.recordCursorCrawl(file, limit, cstop, cursors, total, True)
+            self.__manifest.save()
+            
+    ENTRY_TEMPL = "DESCRIBE %s-%s CSTOP %s"
+    
+    def describeEntries(self, file, iens, cstop=100):
+        """
+        Generator of select entries of file, each DESCRIBEd on its own 
+        ("DESCRIBE 9_6-<ien> CSTOP <cstop>") and cached under that query. For
+        when only a few entries of a big file are needed in depth ex/ the
+        builds of a VistA that aren't in GOLD.
+        
+        One result is yielded for each ien, in the order of iens: None for an
+        entry FMQL couldn't describe (its error reply isn't cached). Those 
+        not cached are fetched together, in the background, and each is 
+        yielded as soon as it is in. As with describeFileEntries, any that 
+        fail every retry raise CrawlIncomplete.
+        """
+        loqueries = [FMQLCacher.ENTRY_TEMPL % (file, ien, cstop) for ien in iens]
+        arrivals = _Arrivals(self.__fetchQueries, [loquery for loquery in loqueries if not self.__manifest.isCached(loquery)])
+        for loquery in loqueries:
+            arrivals.waitFor(loquery)
+            results = list(self.__cachedResults(loquery)) if self.__manifest.isCached(loquery) else []
+            if not results:
+                logging.error("%s: no description from %s" % (self.vistaLabel, loquery))
+            yield results[0] if results else None
+        arrivals.finish()
                     
-    def __isDescribeCached(self, file, limit, cstop):
-        """TODO: good for all but boundary condition where last reply has limit entries and then there's no new reply. Need to record properly in serialized reply"""
-        offset = 0
-        queryFile = ""
-        while True:
-            loquery = FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, offset)
-            lastQueryFile = queryFile
-            queryFile = self.__cacheLocation + "/" + loquery + ".json"
-            if not os.path.isfile(queryFile):
-                if not lastQueryFile:
-                    return False
-                reply = json.load(open(lastQueryFile, "r"))
-                if int(reply["count"]) != limit:
-                    return True
+    def __count(self, file):
+        """
+        COUNT of file, always from the VistA (never cached) but only sent
+        once however many ask for it at the same time.
+        """
+        query = "COUNT " + file
+        # own key: query() of the same COUNT would cache it
+        return IN_FLIGHT.do((self.__vistaKey, query, "uncached"), lambda: int(json.loads(self.__send(query))["count"]))
+        
+    def __send(self, query, transfer=None):
+        """
+        Reply to a query sent on its own (query, COUNT) rather than by the
+        fetchers but, as theirs are, retried (RETRY_POLICY) and within the
+        budget and loadShaper, if any. A reply that isn't JSON is retried.
+        Raises CrawlIncomplete if every retry fails.
+        """
+        if not self.__fmqlIF:
+            raise Exception("Can't fetch %s - %s has no FMQL endpoint or RPC set - exiting" % (query, self.vistaLabel))
+        retryPolicy = FMQLCacher.RETRY_POLICY
+        transfer = {} if transfer is None else transfer
+        for attempt in range(1, retryPolicy.maxRetries + 2):
+            if self.__loadShaper:
+                self.__loadShaper.acquire()
+            if self.__budget:
+                self.__budget.acquire(self.vistaLabel)
+            started = time.time()
+            reply = ""
+            error = None
+            try:
+                reply = self.__fmqlIF.query(query, transfer)
+                json.loads(reply)
+            except ValueError:
+                error = "reply isn't JSON"
+            except Exception:
+                error = str(sys.exc_info()[1]) or sys.exc_info()[0].__name__
+            if self.__budget:
+                self.__budget.release(self.vistaLabel)
+            if self.__loadShaper:
+                self.__loadShaper.record(time.time() - started, transfer.get("wireBytes", len(reply)), error is None)
+            if not error:
+                return reply
+            if attempt > retryPolicy.maxRetries:
                 break
-            offset += limit
+            delay = retryPolicy.delay(attempt - 1)
+            logging.warning("Failed to retrieve %s (%s) - retrying in %.1fs" % (query, error, delay))
+            time.sleep(delay)
+        logging.error("Failed to retrieve %s (%s) - giving up after %d attempts" % (query, error, attempt))
+        summary = CrawlSummary(1)
+        summary.recordDead(query, error, attempt)
+        summary.finish()
+        raise CrawlIncomplete(self.vistaLabel, summary)
+        
+    def __isDescribeCached(self, file, limit, cstop):
+        """
+        From the manifest. For caches from before manifests, pages are counted
+        until one comes back short. If the last has exactly limit entries then 
+        can't tell if it is complete so it isn't.
+        """
+        if self.__manifest.describePages(file, limit, cstop):
+            return True
+        pages = 0
+        count = 0
+        while self.__manifest.isCached(FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, pages * limit)):
+            reply = json.loads(self.__store.get(FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, pages * limit)))
+            pages += 1
+            count += int(reply["count"])
+            if int(reply["count"]) != limit:
+                self.__manifest.recordDescribe(file, limit, cstop, pages, count)
+                self.__manifest.save()
+                return True
         return False
             
     def __cacheDescribe(self, file, limit, cstop):
-        """Assumes all or nothing ie/ missing even one, will get all again"""
+        """
+        Page by page: only pages not yet cached are fetched. The crawl's plan
+        (COUNT and so the pages) is kept in the manifest until every page is
+        in so a crawl that fails or is interrupted resumes where it left off.
+        
+        Returns the number of pages and the _Arrivals of those being fetched.
+        """
         start = time.time()
-        # Never cache COUNT. Go direct.
-        reply = self.__fmqlIF.query("COUNT " + file)
-        total = int(json.loads(reply)["count"])
-        goes = total/limit + 1
-        # logging.info("Caching complete file %s in %d pieces" % (file, goes))
-        queriesQueue = Queue.Queue()
-        offset = 0
-        noQueries = total/limit + 1
-        noThreads = noQueries if noQueries < self.__poolSize else self.__poolSize
+        plan = self.__manifest.describePlan(file, limit, cstop)
+        if not plan:
+            # Never cache COUNT. Go direct. Its result is kept in the plan.
+            total = self.__count(file)
+            self.__manifest.recordDescribePlan(file, limit, cstop, total/limit + 1, total)
+            self.__manifest.save()
+            plan = self.__manifest.describePlan(file, limit, cstop)
+        total = plan["count"]
+        goes = plan["pages"]
+        missingQueries = []
         for i in range(goes):
-            fmqlIF = self.__fmqlIF # TODO: shared makes no speed difference (make sure)
-            t = ThreadedQueriesCacher(fmqlIF, queriesQueue, self.__cacheLocation)
-            t.setDaemon(True)
-            t.start()
-        for i in range(goes):
-            queriesQueue.put(FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, offset))
-            offset += limit
-        queriesQueue.join()
-        # logging.info("Elapsed Time to cache file %s in %d pieces: %s" % (file, noThreads, time.time() - start))
+            loquery = FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, i * limit)
+            if self.__manifest.isCached(loquery):
+                continue
+            # in the store but the manifest missed it (crawl died before a checkpoint)
+            if self.__store.contains(loquery):
+                self.__manifest.recordQuery(loquery, self.__store.get(loquery))
+                continue
+            missingQueries.append(loquery)
+        # logging.info("Caching file %s: %d of %d pieces missing" % (file, len(missingQueries), goes))
+        return goes, _Arrivals(self.__fetchQueries, missingQueries)
+        # logging.info("Elapsed Time to cache file %s in %d pieces: %s" % (file, len(missingQueries), time.time() - start))
                     
+class _Arrivals(object):
+    """
+    Queries being fetched (and cached) in the background so their reader
+    can start on each as soon as it is in rather than waiting for all. 
+    waitFor one and then read it from the cache. finish once all are read:
+    it raises any failure of the fetch (ex/ CrawlIncomplete).
+    """
+    def __init__(self, fetchQueries, queries):
+        self.__pending = set(queries)
+        self.__arrived = set()
+        self.__queue = Queue.Queue()
+        self.__excInfo = None
+        self.__done = not queries
+        if queries:
+            self.__thread = threading.Thread(target=self.__fetch, args=(fetchQueries, queries))
+            self.__thread.setDaemon(True)
+            self.__thread.start()
+        
+    def __fetch(self, fetchQueries, queries):
+        try:
+            fetchQueries(queries, self.__queue.put)
+        except Exception:
+            self.__excInfo = sys.exc_info()
+        finally:
+            self.__queue.put(None)
+            
+    def waitFor(self, query):
+        """Returns at once for a query that was cached before"""
+        if query is not None and query not in self.__pending:
+            return
+        while query not in self.__arrived and not self.__done:
+            arrived = self.__queue.get()
+            if arrived is None:
+                self.__done = True
+            else:
+                self.__arrived.add(arrived)
+        if query not in self.__arrived and self.__excInfo:
+            self.finish()
+                
+    def finish(self):
+        while not self.__done:
+            self.waitFor(None)
+        if self.__excInfo:
+            raise self.__excInfo[0], self.__excInfo[1], self.__excInfo[2]
+
 class FMQLDescribeResult(object):
     """
     TODO: 
@@ -320,64 +1230,244 @@ class RPCLogger:
         logging.critical("BROKERRPC Problem -- %s %s" % (tag, msg))
         
 # Elapsed Time to cache file 9_6 in 35 pieces: 104.36938405
+class FetchPool(object):
+    """
+    A FMQLCacher's fetchers: poolSize ThreadedQueriesCachers, started on
+    first use and kept for every crawl (schema, describes, refresh) until
+    closed. No more queries are in flight than the RPC connection pool has
+    connections however many pages a crawl has.
+
+    fetch blocks until a batch of queries is done and returns its
+    CrawlSummary. onCached(query), if given, is called as each is cached.
+    A query that fails (ex/ a broker reset or a reply that isn't JSON) is
+    retried with backoff (see RetryPolicy). One that fails every retry is
+    left uncached and is one of the summary's dead letters.
+    
+    How many of the fetchers query at once is tuned as replies come back
+    (see AdaptiveConcurrency), from minPoolSize up to poolSize and, with a 
+    budget, only while it has a slot to spare. With a loadShaper, no faster
+    than it allows.
+    """
+    def __init__(self, fmqlIF, store, manifest, poolSize, minPoolSize=None, label="", retryPolicy=None, budget=None, loadShaper=None):
+        self.__fmqlIF = fmqlIF
+        self.__store = store
+        self.__manifest = manifest
+        self.__poolSize = poolSize
+        self.concurrency = AdaptiveConcurrency(minPoolSize or poolSize, poolSize, label)
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.__label = label
+        self.__budget = budget
+        self.__loadShaper = loadShaper
+        self.__queriesQueue = Queue.Queue()
+        self.__fetchers = []
+        self.__lock = threading.Lock()
+        
+    def fetch(self, queries, onCached=None):
+        batch = _FetchBatch(len(queries), onCached)
+        if not queries:
+            return batch.wait()
+        with self.__lock:
+            if not self.__fetchers:
+                for i in range(self.__poolSize):
+                    t = ThreadedQueriesCacher(self.__fmqlIF, self.__queriesQueue, self.__store, self.__manifest, self.concurrency, self.retryPolicy, self.__budget, self.__label, self.__loadShaper)
+                    t.setDaemon(True) # closed explicitly but never hold up exit
+                    t.start()
+                    self.__fetchers.append(t)
+        for query in queries:
+            self.__queriesQueue.put((batch, query))
+        return batch.wait()
+        
+    def close(self):
+        """Let queued work drain and then stop every fetcher"""
+        with self.__lock:
+            for t in self.__fetchers:
+                self.__queriesQueue.put(None)
+            for t in self.__fetchers:
+                t.join()
+            self.__fetchers = []
+                
+class _FetchBatch(object):
+    """Queries of one fetch: how many are left and how it went"""
+    def __init__(self, noQueries, onCached=None):
+        self.onCached = onCached
+        self.__left = noQueries
+        self.__condition = threading.Condition()
+        self.summary = CrawlSummary(noQueries)
+        
+    def done(self):
+        with self.__condition:
+            self.__left -= 1
+            if not self.__left:
+                self.__condition.notify_all()
+                
+    def wait(self):
+        with self.__condition:
+            while self.__left:
+                # timeout keeps the wait interruptible (Ctrl-C)
+                self.__condition.wait(60)
+        self.summary.finish()
+        return self.summary
+        
 class ThreadedQueriesCacher(threading.Thread):
     """
+    One fetcher of a FetchPool. Takes (batch, query) off the queue until
+    it gets None. Only queries when concurrency (and the budget, if any) has
+    a slot and doesn't hold one while waiting to retry. A loadShaper, if
+    any, is waited on first, before taking a slot.
+    
     TODO:
-    - go generic: http://code.activestate.com/recipes/577187-python-thread-pool/
-      - pool manages the overall task queue ie/ queriesQueue ie/ ala tie in to rpc pool
     - check out Twisted as an alternative
     """
-    def __init__(self, fmqlIF, queriesQueue, cacheLocation):
+    def __init__(self, fmqlIF, queriesQueue, store, manifest, concurrency, retryPolicy, budget=None, label="", loadShaper=None):
         threading.Thread.__init__(self)
         self.__fmqlIF = fmqlIF
         self.__queriesQueue = queriesQueue
-        self.__cacheLocation = cacheLocation
+        self.__store = store
+        self.__manifest = manifest
+        self.__concurrency = concurrency
+        self.__retryPolicy = retryPolicy
+        self.__budget = budget
+        self.__label = label
+        self.__loadShaper = loadShaper
         
     def run(self):
         while True:
-            query = self.__queriesQueue.get()
-            reply = self.__fmqlIF.query(query)
-            # Making sure no corruption - could still return a reply with "error"
-            try: 
-                jreply = json.loads(reply)
-            except:
-                logging.error("Failed to retrieve %s" % query)
-            else:
-                jcache = open(self.__cacheLocation + "/" + query + ".json", "w")
-                jcache.write(reply)
-                jcache.close()
-                logging.info("Caching data from query %s" % query)
-                # Monitoring progress with self.__queriesQueue.qsize():
-                # - Problem with pool == 20 or so. Get 0 for last ones and then a hang.
-            self.__queriesQueue.task_done()
+            item = self.__queriesQueue.get()
+            if item is None:
+                self.__queriesQueue.task_done()
+                return
+            batch, query = item
+            try:
+                self.__fetchWithRetries(query, batch)
+            finally:
+                batch.done()
+                self.__queriesQueue.task_done()
             
-class FMQLInterface(object):
+    def __fetchWithRetries(self, query, batch):
+        summary = batch.summary
+        for attempt in range(1, self.__retryPolicy.maxRetries + 2):
+            transfer = {}
+            error = self.__fetch(query, transfer)
+            if not error:
+                summary.recordFetched(attempt, transfer.get("bytes", 0), transfer.get("wireBytes"))
+                if batch.onCached:
+                    batch.onCached(query)
+                return
+            if attempt > self.__retryPolicy.maxRetries:
+                break
+            delay = self.__retryPolicy.delay(attempt - 1)
+            logging.warning("Failed to retrieve %s (%s) - retrying in %.1fs" % (query, error, delay))
+            summary.recordRetry()
+            time.sleep(delay)
+        logging.error("Failed to retrieve %s (%s) - giving up after %d attempts" % (query, error, attempt))
+        summary.recordDead(query, error, attempt)
+            
+    def __fetch(self, query, transfer):
+        """None if cached or what went wrong. Sizes of the reply go in transfer."""
+        if self.__loadShaper:
+            self.__loadShaper.acquire()
+        self.__concurrency.acquire()
+        if self.__budget:
+            self.__budget.acquire(self.__label)
+        started = time.time()
+        reply = ""
+        error = None
+        try:
+            reply = self.__fmqlIF.query(query, transfer)
+            transfer["bytes"] = len(reply)
+            if not cacheReply(self.__store, self.__manifest, query, reply, transfer.get("wireBytes")):
+                error = "reply isn't JSON"
+        except Exception:
+            error = str(sys.exc_info()[1]) or sys.exc_info()[0].__name__
+        if self.__budget:
+            self.__budget.release(self.__label)
+        latency = time.time() - started
+        self.__concurrency.release(latency, len(reply), error is None)
+        if self.__loadShaper:
+            self.__loadShaper.record(latency, transfer.get("wireBytes", len(reply)), error is None)
+        return error
+            
+def cacheReply(store, manifest, query, reply, wireBytes=None):
     """
-    TODO: urllib2 etc timeout in seconds (instead of ? default)
-    ... socket.setdefaulttimeout(default_timeout)
+    Cache a fetched reply unless it is corrupt. Returns True if cached.
+    wireBytes: its size as sent, if it was sent compressed.
+    """
+    # Making sure no corruption - could still return a reply with "error"
+    try: 
+        jreply = json.loads(reply)
+    except ValueError:
+        return False
+    if query.startswith("DESCRIBE TYPES "):
+        return _cacheTypesReply(store, manifest, query, reply)
+    # an entry that can't be described (ex/ deleted) may be by the next crawl
+    if "error" in jreply and re.match(r'DESCRIBE [^ ]+-[^ ]+ CSTOP', query):
+        logging.error("Not caching error for %s (%s)" % (query, jreply["error"]))
+        return True
+    store.put(query, reply)
+    REPLY_CACHE.invalidate(os.path.abspath(store.cacheLocation), query)
+    manifest.recordQuery(query, reply, wireBytes)
+    manifest.checkpoint()
+    logging.info("Caching data from query %s" % query)
+    return True
     
+def _cacheTypesReply(store, manifest, query, reply):
+    """
+    Split a batched DESCRIBE TYPES reply ({"results": [<DESCRIBE TYPE reply>
+    ...]}) into each of its files' DESCRIBE TYPE. The batch itself isn't 
+    cached. A reply without results (ex/ an "error" from an FMQL that 
+    doesn't batch) caches nothing but isn't corrupt so isn't retried.
+    """
+    jreply = json.loads(reply)
+    if not isinstance(jreply.get("results"), list):
+        logging.info("No results for batched %s (%s)" % (query, jreply.get("error", "")))
+        return True
+    files = set(query[len("DESCRIBE TYPES "):].split(","))
+    vistaKey = os.path.abspath(store.cacheLocation)
+    # each file's reply is its slice of the batch, byte for byte, so it 
+    # hashes as the same reply fetched on its own would
+    for result, typeReply in zip(jreply["results"], iterReplyResults(reply, raw=True)):
+        file = re.sub(r'\.', '_', result.get("number", ""))
+        if file not in files:
+            continue
+        loquery = "DESCRIBE TYPE " + file
+        store.put(loquery, typeReply)
+        REPLY_CACHE.invalidate(vistaKey, loquery)
+        manifest.recordQuery(loquery, typeReply)
+        manifest.checkpoint()
+    logging.info("Caching data from query %s" % query)
+    return True
+            
+class FMQLInterface(object):
+    """
     Allow access to either the RPC directly (connection pool) or 
-    to the FMQL EP. Note that you shouldn't invoke more RPCs than
-    the RPC pool size at any one time.
+    to the FMQL EP, over kept-alive connections (HTTP connection pool)
+    if given one. With the pool, replies come compressed if the EP can and
+    transfer (if given) gets "wireBytes", a reply's size as sent. Note 
+    that you shouldn't invoke more RPCs than the RPC pool size at any one
+    time.
     
     Note: copy of fmqlc utility. 
     """
-    def __init__(self, fmqlEP=None, rpcCPool=None):
+    def __init__(self, fmqlEP=None, rpcCPool=None, httpCPool=None):
         self.fmqlEP = fmqlEP
         self.rpcCPool = rpcCPool
+        self.httpCPool = httpCPool
         if not (fmqlEP or rpcCPool):
             raise Exception("Must specific either an RPC CPool or an FMQL EP")
     
-    def query(self, query):
+    def query(self, query, transfer=None):
         if self.rpcCPool:
             reply = self.rpcCPool.invokeRPC("CG FMQL QP", [self.__queryToRPCForm(query)])
             return reply
+        if self.httpCPool:
+            return self.httpCPool.query(query, transfer)
         return urllib2.urlopen(self.fmqlEP + "?" + urllib.urlencode({"fmql": query})).read()
 
     QUERYFORMS = { # TODO: enforce mandatory
         "COUNT": ["COUNT", [("TYPE", "COUNT ([\d\_]+)")]],
-        "DESCRIBE TYPE": ["DESCRIBETYPE", [("TYPE", "DESCRIBE TYPE ([\d\_]+)")]],
-        "DESCRIBE [\d\_]": ["DESCRIBE", [("TYPE", "DESCRIBE ([\d\_]+)"), ("LIMIT", "LIMIT (\d+)"), ("OFFSET", "OFFSET (\d+)"), ("CNODESTOP", "CSTOP (\d+)")]],
+        "DESCRIBE TYPE ": ["DESCRIBETYPE", [("TYPE", "DESCRIBE TYPE ([\d\_]+)")]],
+        "DESCRIBE TYPES ": ["DESCRIBETYPES", [("TYPES", "DESCRIBE TYPES ([\d\_,]+)")]],
+        "DESCRIBE [\d\_]": ["DESCRIBE", [("TYPE", "DESCRIBE ([\d\_]+) "), ("ID", "DESCRIBE ([\d\_]+-[\d\.]+)"), ("LIMIT", "LIMIT (\d+)"), ("OFFSET", "OFFSET (\d+)"), ("AFTERIEN", "AFTERIEN ([\d\.]+)"), ("CNODESTOP", "CSTOP (\d+)")]],
         "SELECT TYPES": ["SELECTALLTYPES", []]
     }
         
@@ -0,0 +1,388 @@
+#
+## FMQL Crawl Concurrency
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+How a crawl fetches, whichever does the fetching - FetchPool (threads) or
+AsyncFetchPool (event loop):
+- AdaptiveConcurrency: how many queries are in flight at once. Every VistA
+and every link to it is different so rather than one fixed number for all,
+a crawl starts small and tunes itself as it goes
+- RetryPolicy: how often and how long after a failure a query is retried.
+Busy production VistAs reset broker connections now and again.
+- CrawlSummary: what a crawl fetched, retried and, after every retry,
+still failed (its "dead letters")
+- CrawlBudget: when many VistAs are crawled at once, a cap on queries in
+flight across all of them, shared out fairly
+- LoadShaper: a cap on the rate (queries and bytes a second) of a crawl,
+for VistAs in clinical use
+"""
+
+import time
+import random
+import threading
+import logging
+from collections import defaultdict, deque
+
+__all__ = ['AdaptiveConcurrency', 'RetryPolicy', 'CrawlSummary', 'CrawlBudget', 'LoadShaper']
+
+class AdaptiveConcurrency(object):
+    """
+    A limit on queries in flight, between minLimit and maxLimit, adjusted
+    every window (a few seconds) of replies:
+    - errors (failed or corrupt replies): halve it
+    - latency grown well past the best seen: the VistA is saturated, back
+    off a quarter
+    - throughput (replies/s or bytes/s) rising: go up by half again
+    - otherwise hold, probing one higher every few windows in case the
+    VistA or link has got faster
+
+    minLimit == maxLimit is a fixed limit ie/ no tuning.
+
+    Fetcher threads acquire a slot before a query and release it, with
+    how it went, after. An event loop checks limit itself and just records.
+    """
+    WINDOW_SECONDS = 2.0
+    LATENCY_GROWTH = 2.0
+    THROUGHPUT_GAIN = 1.1
+    PROBE_EVERY = 5
+
+    def __init__(self, minLimit, maxLimit, label=""):
+        if not 1 <= minLimit <= maxLimit:
+            raise ValueError("Concurrency must be 1 <= min (%d) <= max (%d)" % (minLimit, maxLimit))
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.limit = minLimit
+        self.inFlight = 0
+        self.__label = label
+        self.__condition = threading.Condition()
+        self.__bestLatency = None
+        self.__lastRates = None
+        self.__holds = 0
+        self.__startWindow()
+
+    def acquire(self):
+        with self.__condition:
+            while self.inFlight >= self.limit:
+                self.__condition.wait(1)
+            self.inFlight += 1
+
+    def release(self, latency, noBytes, ok=True):
+        with self.__condition:
+            self.inFlight -= 1
+            self.__record(latency, noBytes, ok)
+            self.__condition.notify_all()
+
+    def record(self, latency, noBytes, ok=True):
+        with self.__condition:
+            self.__record(latency, noBytes, ok)
+
+    def __record(self, latency, noBytes, ok):
+        if self.minLimit == self.maxLimit:
+            return
+        self.__replies += 1
+        self.__bytes += noBytes
+        self.__latency += latency
+        if not ok:
+            self.__errors += 1
+        elapsed = time.time() - self.__windowStart
+        if elapsed >= AdaptiveConcurrency.WINDOW_SECONDS:
+            self.__adjust(elapsed)
+
+    def __adjust(self, elapsed):
+        rates = (self.__replies / elapsed, self.__bytes / elapsed)
+        latency = self.__latency / self.__replies
+        if self.__bestLatency is None or latency < self.__bestLatency:
+            self.__bestLatency = latency
+        limit = self.limit
+        if self.__errors:
+            limit, reason = max(self.minLimit, limit / 2), "%d errors" % self.__errors
+        elif latency > self.__bestLatency * AdaptiveConcurrency.LATENCY_GROWTH:
+            limit, reason = max(self.minLimit, limit - max(1, limit / 4)), "latency %.2fs up from %.2fs" % (latency, self.__bestLatency)
+        elif self.__lastRates is None or rates[0] > self.__lastRates[0] * AdaptiveConcurrency.THROUGHPUT_GAIN or rates[1] > self.__lastRates[1] * AdaptiveConcurrency.THROUGHPUT_GAIN:
+            limit, reason = min(self.maxLimit, limit + max(1, limit / 2)), "throughput rising to %.1f replies/s, %d bytes/s" % rates
+        else:
+            self.__holds += 1
+            if self.__holds % AdaptiveConcurrency.PROBE_EVERY == 0:
+                limit, reason = min(self.maxLimit, limit + 1), "probing"
+        if limit != self.limit:
+            logging.info("%s: concurrency %d -> %d (%s)" % (self.__label, self.limit, limit, reason))
+            self.limit = limit
+            self.__holds = 0
+        self.__lastRates = rates
+        self.__startWindow()
+
+    def __startWindow(self):
+        self.__windowStart = time.time()
+        self.__replies = 0
+        self.__bytes = 0
+        self.__latency = 0.0
+        self.__errors = 0
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter: the nth retry waits between half and
+    all of baseDelay * 2^n (capped at maxDelay) so queries that failed
+    together don't all retry together.
+    """
+    def __init__(self, maxRetries=4, baseDelay=1.0, maxDelay=60.0):
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def delay(self, retry):
+        """Seconds before retry (0 is the first retry)"""
+        delay = min(self.maxDelay, self.baseDelay * (2 ** retry))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+class CrawlSummary(object):
+    """
+    Tally of one fetch of queries. Fetchers record as they go so it is
+    thread safe.
+    """
+    def __init__(self, noQueries):
+        self.noQueries = noQueries
+        self.noFetched = 0
+        self.noFetchedOnRetry = 0
+        self.noRetries = 0
+        self.noBytes = 0
+        self.noWireBytes = 0 # as sent ie/ compressed
+        self.deadLetters = {} # query -> (last error, attempts)
+        self.elapsed = None
+        self.__started = time.time()
+        self.__lock = threading.Lock()
+
+    def recordFetched(self, attempts, noBytes=0, wireBytes=None):
+        with self.__lock:
+            self.noFetched += 1
+            self.noBytes += noBytes
+            self.noWireBytes += noBytes if wireBytes is None else wireBytes
+            if attempts > 1:
+                self.noFetchedOnRetry += 1
+
+    def recordRetry(self):
+        with self.__lock:
+            self.noRetries += 1
+
+    def recordDead(self, query, error, attempts):
+        with self.__lock:
+            self.deadLetters[query] = (error, attempts)
+
+    def finish(self):
+        self.elapsed = time.time() - self.__started
+
+    def __str__(self):
+        summary = "%d queries in %.1fs: %d fetched (%d on a retry), %d retries, %d failed" % (self.noQueries, self.elapsed if self.elapsed is not None else time.time() - self.__started, self.noFetched, self.noFetchedOnRetry, self.noRetries, len(self.deadLetters))
+        if self.noWireBytes != self.noBytes:
+            summary += ", %d bytes as %d over the wire" % (self.noBytes, self.noWireBytes)
+        for query in sorted(self.deadLetters)[:10]:
+            summary += "\n  %s - %s (%d attempts)" % (query, self.deadLetters[query][0], self.deadLetters[query][1])
+        if len(self.deadLetters) > 10:
+            summary += "\n  ... and %d more" % (len(self.deadLetters) - 10)
+        return summary
+
+class CrawlBudget(object):
+    """
+    Cap on queries in flight across every VistA being crawled, on top of
+    each VistA's own (AdaptiveConcurrency). Fair: a VistA waits for a slot
+    while another VistA waiting for one has fewer in flight, so a slot freed 
+    by a slow VistA goes to the others before it takes it back. A slow site 
+    can't hold up the rest of a fleet.
+
+    Fetcher threads acquire and release a slot around each query. An event
+    loop can't block so it tryAcquires: a refusal counts as waiting for
+    WANT_SECONDS.
+    """
+    WANT_SECONDS = 2.0
+
+    def __init__(self, maxInFlight):
+        if maxInFlight < 1:
+            raise ValueError("Budget must be at least 1, not %d" % maxInFlight)
+        self.maxInFlight = maxInFlight
+        self.inFlight = 0
+        self.__inFlightOf = defaultdict(int)
+        self.__waiting = defaultdict(int) # label -> threads waiting
+        self.__wanted = {} # label -> when last refused a tryAcquire
+        self.__condition = threading.Condition()
+
+    def acquire(self, label):
+        with self.__condition:
+            self.__waiting[label] += 1
+            try:
+                while not self.__mayTake(label):
+                    self.__condition.wait(1)
+            finally:
+                self.__waiting[label] -= 1
+            self.__take(label)
+
+    def tryAcquire(self, label):
+        with self.__condition:
+            if not self.__mayTake(label):
+                self.__wanted[label] = time.time()
+                return False
+            self.__wanted.pop(label, None)
+            self.__take(label)
+            return True
+
+    def release(self, label):
+        with self.__condition:
+            self.inFlight -= 1
+            self.__inFlightOf[label] -= 1
+            self.__condition.notify_all()
+
+    def inFlightOf(self, label):
+        return self.__inFlightOf[label]
+
+    def __mayTake(self, label):
+        if self.inFlight >= self.maxInFlight:
+            return False
+        now = time.time()
+        mine = self.__inFlightOf[label]
+        for other in set(self.__waiting) | set(self.__wanted):
+            if other == label or self.__inFlightOf[other] >= mine:
+                continue
+            if self.__waiting[other] or now - self.__wanted.get(other, 0) < CrawlBudget.WANT_SECONDS:
+                return False
+        return True
+
+    def __take(self, label):
+        self.inFlight += 1
+        self.__inFlightOf[label] += 1
+
+class LoadShaper(object):
+    """
+    Keeps a crawl from degrading a VistA clinicians are using. Where
+    AdaptiveConcurrency limits how many queries are in flight, this limits
+    how fast they go:
+    - token buckets for queries (requestsPerSecond) and reply bytes 
+    (bytesPerSecond) a second. A query waits for a token. Its reply's bytes
+    are paid for once in and, while they are owed, the next query waits.
+    - windows: times of day ("07:00-19:00", "22:00-02:00") when the buckets
+    apply. Outside them (ex/ at night) a crawl goes at full speed. None 
+    means always. A requestsPerSecond of 0 pauses a crawl in its windows.
+    - back off: once latency grows past LATENCY_GROWTH times the best seen 
+    (its baseline), queries a second are cut in proportion, from the set 
+    rate or, if none, from the rate the VistA was answering at, until 
+    latency comes back down. Applies in or out of the windows.
+
+    Fetcher threads acquire before each query and record after. An event
+    loop checks delay and takes when it is 0.
+    """
+    LATENCY_GROWTH = 2.0
+    SMOOTHING = 0.2 # weight of the latest reply in the latency average
+    WARMUP = 5 # replies before latency has a baseline
+    MIN_BASELINE = 0.1 # seconds - faster replies than this are all as good
+    MIN_RATE = 0.1
+    RATE_SECONDS = 10.0 # over which the answered rate is measured
+    PAUSE_CHECK = 30.0 # while paused, seconds between checks of the windows
+
+    def __init__(self, requestsPerSecond=None, bytesPerSecond=None, windows=None, label=""):
+        self.requestsPerSecond = requestsPerSecond
+        self.bytesPerSecond = bytesPerSecond
+        self.windows = [LoadShaper.parseWindow(window) for window in (windows or [])]
+        self.__label = label
+        self.__condition = threading.Condition()
+        self.__requestTokens = 1.0
+        self.__byteTokens = 0.0 # < 0 is bytes owed
+        self.__refilled = time.time()
+        self.__latency = None
+        self.__baseline = None
+        self.__noReplies = 0
+        self.__answered = deque()
+        self.__backingOff = False
+
+    @staticmethod
+    def parseWindow(window):
+        """ "HH:MM-HH:MM" -> (start, end) minutes into the day"""
+        try:
+            start, end = [int(hhmm.split(":")[0]) * 60 + int(hhmm.split(":")[1]) for hhmm in window.split("-")]
+        except (ValueError, IndexError):
+            raise ValueError("Window must be HH:MM-HH:MM, not %s" % window)
+        return start, end
+
+    def inWindow(self, now=None):
+        if not self.windows:
+            return True
+        localNow = time.localtime(now)
+        minute = localNow.tm_hour * 60 + localNow.tm_min
+        for start, end in self.windows:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return True
+        return False
+
+    def acquire(self):
+        with self.__condition:
+            while True:
+                delay = self.__delay()
+                if delay <= 0:
+                    self.__requestTokens -= 1
+                    return
+                self.__condition.wait(delay)
+
+    def delay(self):
+        """Seconds before a query may go. 0 if one may now."""
+        with self.__condition:
+            return max(0, self.__delay())
+
+    def take(self):
+        with self.__condition:
+            self.__requestTokens -= 1
+
+    def record(self, latency, noBytes, ok=True):
+        with self.__condition:
+            now = time.time()
+            self.__refill(now)
+            self.__byteTokens -= noBytes
+            if not ok:
+                return
+            self.__answered.append(now)
+            self.__noReplies += 1
+            self.__latency = latency if self.__latency is None else LoadShaper.SMOOTHING * latency + (1 - LoadShaper.SMOOTHING) * self.__latency
+            if self.__noReplies >= LoadShaper.WARMUP and (self.__baseline is None or self.__latency < self.__baseline):
+                self.__baseline = max(LoadShaper.MIN_BASELINE, self.__latency)
+
+    def __rates(self, now):
+        """(queries/s, bytes/s) allowed now. None is no limit."""
+        requestRate, byteRate = (self.requestsPerSecond, self.bytesPerSecond) if self.inWindow(now) else (None, None)
+        while self.__answered and now - self.__answered[0] > LoadShaper.RATE_SECONDS:
+            self.__answered.popleft()
+        backingOff = self.__baseline is not None and self.__latency > self.__baseline * LoadShaper.LATENCY_GROWTH
+        if backingOff and requestRate != 0:
+            answeredRate = len(self.__answered) / LoadShaper.RATE_SECONDS
+            requestRate = max(LoadShaper.MIN_RATE, (requestRate if requestRate is not None else answeredRate) * self.__baseline * LoadShaper.LATENCY_GROWTH / self.__latency)
+        if backingOff != self.__backingOff:
+            if backingOff:
+                logging.info("%s: latency %.2fs up from %.2fs - slowing to %.1f queries/s" % (self.__label, self.__latency, self.__baseline, requestRate))
+            else:
+                logging.info("%s: latency back to %.2fs - no longer slowed" % (self.__label, self.__latency))
+            self.__backingOff = backingOff
+        return requestRate, byteRate
+
+    def __refill(self, now):
+        requestRate, byteRate = self.__rates(now)
+        elapsed = now - self.__refilled
+        self.__refilled = now
+        if requestRate is None:
+            self.__requestTokens = 1.0
+        else: # at most a second's worth saved up
+            self.__requestTokens = min(max(1.0, requestRate), self.__requestTokens + elapsed * requestRate)
+        if byteRate is None:
+            self.__byteTokens = 0.0
+        else:
+            self.__byteTokens = min(byteRate, self.__byteTokens + elapsed * byteRate)
+        return requestRate, byteRate
+
+    def __delay(self):
+        requestRate, byteRate = self.__refill(time.time())
+        if requestRate == 0:
+            return LoadShaper.PAUSE_CHECK
+        delay = 0
+        if self.__requestTokens < 1:
+            delay = (1 - self.__requestTokens) / requestRate
+        if self.__byteTokens < 0 and byteRate:
+            delay = max(delay, -self.__byteTokens / byteRate)
+        return delay
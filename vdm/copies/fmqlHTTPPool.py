@@ -0,0 +1,148 @@
+#
+## FMQL HTTP Connection Pool
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Keep-alive connections to an FMQL web endpoint (fmqlEP), the HTTP equivalent
+of brokerRPC's RPCConnectionPool. A crawl's fetcher threads share up to
+poolSize persistent connections so thousands of queries pay for a handful
+of TCP (and TLS) handshakes, not one each. On a high latency link, those
+handshakes take longer than most replies.
+
+A connection idle for longer than idleTimeout is replaced rather than reused
+as servers drop idle keep-alive connections. If a reused connection turns
+out to have been dropped anyway, the query is resent once on a new one.
+
+Replies are verbose JSON so they are asked for compressed (gzip or deflate)
+and decoded here. A server that doesn't compress just sends them as is. How
+many bytes came over the wire is passed back so a crawl can record it.
+
+TODO:
+- proxies (urllib2 honored http_proxy)
+"""
+
+import time
+import zlib
+import socket
+import httplib
+import urllib
+import urlparse
+import Queue
+import logging
+
+__all__ = ['HTTPConnectionPool', 'ACCEPT_ENCODING', 'decodeBody']
+
+ACCEPT_ENCODING = "gzip, deflate"
+
+def decodeBody(body, contentEncoding):
+    """Body of a reply as sent with Content-Encoding contentEncoding, decoded"""
+    contentEncoding = (contentEncoding or "identity").strip().lower()
+    try:
+        if contentEncoding in ["gzip", "x-gzip"]:
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if contentEncoding == "deflate":
+            try:
+                return zlib.decompress(body)
+            except zlib.error: # some servers send raw deflate, no zlib header
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+    except zlib.error, e:
+        raise IOError("Corrupt %s reply (%s)" % (contentEncoding, str(e)))
+    if contentEncoding != "identity":
+        raise IOError("Unsupported Content-Encoding %s" % contentEncoding)
+    return body
+
+class HTTPConnectionPool(object):
+    """
+    Thread-safe: query blocks until one of the poolSize connections is free.
+    Connections are made as needed, not up front, and, as with the RPC pool,
+    the most recently used is reused first so a slow crawl keeps to a few.
+    """
+    # Seconds an unused connection is kept open
+    IDLE_TIMEOUT = 30
+
+    # Seconds to connect and, once connected, to wait on any read
+    CONNECT_TIMEOUT = 30
+    READ_TIMEOUT = 300
+
+    def __init__(self, fmqlEP, poolSize, idleTimeout=IDLE_TIMEOUT, connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT):
+        parsedEP = urlparse.urlparse(fmqlEP)
+        if parsedEP.scheme not in ["http", "https"]:
+            raise ValueError("FMQL endpoint must be http or https, not %s" % fmqlEP)
+        self.__connectionClass = httplib.HTTPSConnection if parsedEP.scheme == "https" else httplib.HTTPConnection
+        self.__host = parsedEP.hostname
+        self.__port = parsedEP.port
+        self.__path = parsedEP.path or "/"
+        self.poolSize = poolSize
+        self.idleTimeout = idleTimeout
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        # (connection, last used) or None for a connection not yet made
+        self.__connectionQueue = Queue.LifoQueue()
+        for i in range(poolSize):
+            self.__connectionQueue.put(None)
+
+    def query(self, query, transfer=None):
+        """
+        Reply (body, decoded) to an FMQL query. Anything but HTTP 200 is an
+        IOError. If given, transfer["wireBytes"] is set to the size of the 
+        body as sent.
+        """
+        pooled = self.__connectionQueue.get()
+        connection = None
+        try:
+            if pooled and time.time() - pooled[1] <= self.idleTimeout:
+                connection = pooled[0]
+                try:
+                    status, reply, contentEncoding = self.__request(connection, query)
+                except (httplib.HTTPException, socket.error):
+                    # dropped while idle: once more on a new connection
+                    logging.debug("Keep-alive connection to %s dropped - reconnecting" % self.__host)
+                    connection.close()
+                    connection = None
+            elif pooled:
+                pooled[0].close()
+            if not connection:
+                connection = self.__connect()
+                status, reply, contentEncoding = self.__request(connection, query)
+        except:
+            if connection:
+                connection.close()
+            self.__connectionQueue.put(None)
+            raise
+        self.__connectionQueue.put((connection, time.time()) if connection.sock else None)
+        if status != 200:
+            raise IOError("HTTP %d" % status)
+        if transfer is not None:
+            transfer["wireBytes"] = len(reply)
+        return decodeBody(reply, contentEncoding)
+
+    def close(self):
+        """Close idle connections. The pool stays usable."""
+        idle = []
+        while True:
+            try:
+                idle.append(self.__connectionQueue.get_nowait())
+            except Queue.Empty:
+                break
+        for pooled in idle:
+            if pooled:
+                pooled[0].close()
+            self.__connectionQueue.put(None)
+
+    def __connect(self):
+        connection = self.__connectionClass(self.__host, self.__port, timeout=self.connectTimeout)
+        connection.connect()
+        connection.sock.settimeout(self.readTimeout)
+        return connection
+
+    def __request(self, connection, query):
+        connection.request("GET", self.__path + "?" + urllib.urlencode({"fmql": query}), headers={"Accept": "application/json", "Accept-Encoding": ACCEPT_ENCODING})
+        response = connection.getresponse()
+        reply = response.read() # all of it or the connection can't be reused
+        if response.will_close:
+            connection.close()
+        return response.status, reply, response.getheader("content-encoding")
@@ -0,0 +1,197 @@
+#
+## FMQL Stand In
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+A stand in for a VistA's FMQL, answering queries from a cached VistA (ex/
+the bundled GOLD) so crawls can be tried out without a live VistA:
+- a query cached as is (SELECT TYPES, DESCRIBE TYPE ...) gets its cached reply
+- COUNT and DESCRIBE of a file paged through in the cache are answered from
+its entries, paged with LIMIT and either OFFSET or AFTERIEN, as is DESCRIBE
+of one of them by id (ex/ DESCRIBE 9_6-12 CSTOP 10000)
+- batched DESCRIBE TYPES (ex/ DESCRIBE TYPES 2,2_01,200) gets the cached
+DESCRIBE TYPE of each file, as {"results": [...]}, unless -t (no batching),
+as with an FMQL from before batches
+
+Use it in place of an FMQLInterface (it has query) or serve it as an FMQL
+endpoint:
+$ python fmqlStandIn.py Caches/GOLD 9000
+and crawl http://localhost:9000/fmqlEP
+
+A real FMQL walks a file's index from its start to reach an OFFSET but goes
+straight to an AFTERIEN. With walkDelay (-w), the stand in takes that long
+per entry walked so the difference shows.
+
+Served replies are compressed (gzip or deflate) for clients that accept it
+unless -u (uncompressed), as with an endpoint that doesn't compress.
+"""
+
+import re
+import sys
+import time
+import zlib
+import json
+import getopt
+import bisect
+import urlparse
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+from fmqlCacheStores import makeCacheStore, CacheManifest, iterReplyResults, normalizeQuery
+
+__all__ = ['FMQLStandIn', 'serveStandIn']
+
+class FMQLStandIn(object):
+    """
+    Answers FMQL queries from the cache in cacheLocation. A file's entries
+    are read (from its deepest CSTOP DESCRIBE) the first time they are asked
+    for and then kept.
+    """
+    def __init__(self, cacheLocation, walkDelay=0.0, batchTypes=True):
+        self.__store = makeCacheStore(cacheLocation)
+        self.__manifest = CacheManifest(self.__store)
+        self.walkDelay = walkDelay
+        self.batchTypes = batchTypes
+        self.__entries = {}
+        self.__iens = {}
+        self.__lock = threading.Lock()
+
+    def query(self, query, transfer=None):
+        """As FMQLInterface's. Nothing is sent so transfer is left as is."""
+        query = normalizeQuery(query)
+        reply = self.__store.get(query)
+        if reply is not None:
+            return reply
+        match = re.match(r'DESCRIBE TYPES ([\d_,]+)$', query)
+        if match and self.batchTypes:
+            replies = self.__store.getMany(["DESCRIBE TYPE " + file for file in match.group(1).split(",")])
+            # each reply as cached, byte for byte, as FMQL would send it
+            results = [replies[typeQuery] for typeQuery in ("DESCRIBE TYPE " + file for file in match.group(1).split(",")) if typeQuery in replies]
+            return '{"count": "%d", "results": [%s]}' % (len(results), ", ".join(results))
+        match = re.match(r'COUNT ([\d_]+)$', query)
+        if match:
+            entries = self.__fileEntries(match.group(1))
+            if entries is None:
+                return self.__error("%s isn't cached" % match.group(1))
+            return json.dumps({"count": str(len(entries))})
+        match = re.match(r'DESCRIBE ([\d_]+)(?: CSTOP \d+)? LIMIT (\d+) (OFFSET|AFTERIEN) ([\d\.]+)$', query)
+        if match:
+            entries = self.__fileEntries(match.group(1))
+            if entries is None:
+                return self.__error("%s isn't cached" % match.group(1))
+            limit = int(match.group(2))
+            if match.group(3) == "OFFSET":
+                start = int(match.group(4))
+                time.sleep(self.walkDelay * (start + limit))
+            else:
+                start = bisect.bisect_right(self.__iens[match.group(1)], float(match.group(4)))
+                time.sleep(self.walkDelay * limit)
+            results = [entry for ien, entry in entries[start:start + limit]]
+            return json.dumps({"count": str(len(results)), "results": results})
+        match = re.match(r'DESCRIBE ([\d_]+)-([\d\.]+)(?: CSTOP \d+)?$', query)
+        if match:
+            entries = self.__fileEntries(match.group(1))
+            if entries is None:
+                return self.__error("%s isn't cached" % match.group(1))
+            at = bisect.bisect_left(self.__iens[match.group(1)], float(match.group(2)))
+            if at == len(entries) or entries[at][0] != float(match.group(2)):
+                return self.__error("No entry %s-%s" % (match.group(1), match.group(2)))
+            return json.dumps({"count": "1", "results": [entries[at][1]]})
+        return self.__error("Stand in can't answer %s" % query)
+
+    def __error(self, message):
+        return json.dumps({"error": message})
+
+    def __fileEntries(self, file):
+        """[(ien, entry)] in IEN order or None if the file isn't cached"""
+        with self.__lock:
+            if file not in self.__entries:
+                describes = [(limit, cstop, described["pages"]) for limit, cstop, described in self.__manifest.describesOfFile(file)]
+                if not describes:
+                    # zipped (its manifest isn't kept) or from before
+                    # manifests: first pages from the store, paged until short
+                    firstPage = re.compile(r'DESCRIBE %s CSTOP (\d+) LIMIT (\d+) OFFSET 0$' % re.escape(file))
+                    describes = [(int(match.group(2)), match.group(1), None) for match in (firstPage.match(query) for query in self.__store.queries()) if match]
+                if not describes:
+                    return None
+                limit, cstop, pages = max(describes, key=lambda describe: (int(describe[1]), describe[0]))
+                entries = []
+                page = 0
+                while pages is None or page < pages:
+                    replyFile = self.__store.open("DESCRIBE %s CSTOP %s LIMIT %d OFFSET %d" % (file, cstop, limit, page * limit))
+                    if replyFile is None:
+                        break
+                    noEntries = 0
+                    try:
+                        for entry in iterReplyResults(replyFile):
+                            entries.append((float(entry["uri"]["value"].split("-")[1]), entry))
+                            noEntries += 1
+                    finally:
+                        replyFile.close()
+                    page += 1
+                    if pages is None and noEntries < limit:
+                        break
+                entries.sort(key=lambda ienEntry: ienEntry[0])
+                self.__entries[file] = entries
+                self.__iens[file] = [ien for ien, entry in entries]
+            return self.__entries[file]
+
+class _StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serveStandIn(standIn, port, path="/fmqlEP", compress=True):
+    """
+    HTTP FMQL endpoint (GET <path>?fmql=<query>) for a stand in. Returns the
+    server: serve_forever() it or run it in a thread.
+    
+    With compress, replies are gzip or deflate encoded if the request's
+    Accept-Encoding allows.
+    """
+    class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, as a real endpoint
+        def do_GET(self):
+            parsedPath = urlparse.urlparse(self.path)
+            queries = urlparse.parse_qs(parsedPath.query).get("fmql")
+            if parsedPath.path != path or not queries:
+                self.send_error(404)
+                return
+            reply = standIn.query(queries[0])
+            contentEncoding = None
+            if compress:
+                acceptEncoding = [encoding.split(";")[0].strip().lower() for encoding in self.headers.get("Accept-Encoding", "").split(",")]
+                if "gzip" in acceptEncoding:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    reply, contentEncoding = compressor.compress(reply) + compressor.flush(), "gzip"
+                elif "deflate" in acceptEncoding:
+                    reply, contentEncoding = zlib.compress(reply), "deflate"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if contentEncoding:
+                self.send_header("Content-Encoding", contentEncoding)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+    return _StandInServer(("", port), StandInHandler)
+
+# ######################## Stand In Server ##########################
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    opts, args = getopt.getopt(sys.argv[1:], "w:ut")
+    opts = dict(opts)
+    if len(args) != 2:
+        print "Enter [-w walkDelay] [-u] [-t] <cacheLocation> <port> ex/ Caches/GOLD 9000"
+        return
+    server = serveStandIn(FMQLStandIn(args[0], float(opts.get("-w", 0.0)), "-t" not in opts), int(args[1]), compress="-u" not in opts)
+    print "Serving %s as http://localhost:%s/fmqlEP" % (args[0], args[1])
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ import logging
 import operator
 from collections import OrderedDict, defaultdict
 from copies.fmqlCacher import FMQLDescribeResult
+from vistaSnapshots import loadSnapshot, saveSnapshot
 
 __all__ = ['VistaBuilds']
 
@@ -31,7 +32,6 @@ class VistaBuilds(object):
     - test install for files now in here ...
       - important: ex/ files like 19620.1 showing up in listFiles due to COMPARE DSIR 5.2
       which though loaded was never installed
-    - consider pass in names NOT to load/index ie/ if in Base, why reload from remote system. ie/ depth not needed if date distrib equal.
     - pkg tagger (list of regexps - [(r'xx', PKGNAME)] ie build pkg tagger
       - "package name or prefix"  
       - will use (uri, label) form from Cache update
@@ -40,12 +40,17 @@ class VistaBuilds(object):
     - defaults in Comparer ... better done in here
     - handle cnodes generically ie/ if there properly then deref file by name into the desired label for an index. Make the indexes into one dictionary ie/ self.__indexes
     - consider link into (static) release notes
-    - current version grabs everything about every build into a Cache. Instead
-    grab select builds only, one by one. ex/ grab only those not in base.
+    - go by more than top level fields when matching a baseline ex/ checksums of routines
     """
-    def __init__(self, vistaLabel, fmqlCacher):
+    def __init__(self, vistaLabel, fmqlCacher, baseline=None):
+        """
+        @param baseline: VistaBuilds (ex/ GOLD's) to take the details of 
+        builds from where this VistA has the same build. Only builds it
+        doesn't have are fetched in full.
+        """
         self.vistaLabel = vistaLabel
         self.__fmqlCacher = fmqlCacher
+        self.__baseline = baseline
         self.__indexNCleanBuilds() 
                 
     def __str__(self):
@@ -183,7 +188,11 @@ class VistaBuilds(object):
         """
         return [] if buildName not in self.__buildMultiples else self.__buildMultiples[buildName]
         
-    __ALL_LIMIT = 200
+    def fingerprint(self):
+        """Changes whenever the cached Builds and Installs indexed here change"""
+        return self.__fmqlCacher.fingerprint(VistaBuilds.__SNAPSHOT_QUERIES)
+        
+    __SNAPSHOT_QUERIES = ["DESCRIBE 9_6 ", "DESCRIBE 9_6-", "DESCRIBE 9_7 "]
                 
     def __indexNCleanBuilds(self):
         """
@@ -192,7 +201,29 @@ class VistaBuilds(object):
         CNodes: only see ...
         'required_build', u'install_questions', u'multiple_build', u'file', 'build_components', u'package_namespace_or_prefix' 
         but no "global"
+
+        Loads the indexes from a snapshot if the cache (and the baseline's)
+        hasn't changed since they were last built.
         """
+        snapshot = loadSnapshot(self.__fmqlCacher, "VistaBuilds", VistaBuilds.__SNAPSHOT_QUERIES)
+        baselineFingerprint = self.__baseline.fingerprint() if self.__baseline else None
+        if snapshot and snapshot.get("baseline") != baselineFingerprint:
+            logging.info("%s: Builds snapshot was built against another baseline" % self.vistaLabel)
+            snapshot = None
+        if snapshot:
+            self.__noSpecificValues = snapshot["noSpecificValues"]
+            self.__buildAbouts = snapshot["buildAbouts"]
+            self.__buildFiles = snapshot["buildFiles"]
+            self.__buildMultiples = snapshot["buildMultiples"]
+            self.__buildGlobals = snapshot["buildGlobals"]
+            self.__buildRoutines = snapshot["buildRoutines"]
+            self.__buildRPCs = snapshot["buildRPCs"]
+            self.__buildsByPackageName = snapshot["buildsByPackageName"]
+            self.__packages = snapshot["packages"]
+            self.__installAbouts = snapshot["installAbouts"]
+            self.__buildAboutsInstalled = snapshot["buildAboutsInstalled"]
+            logging.info("%s: Builds - loaded Builds Index from snapshot" % self.vistaLabel)
+            return
         logging.info("%s: Builds - building Builds Index ..." % self.vistaLabel)
         start = datetime.now()
         self.__noSpecificValues = 0
@@ -205,54 +236,14 @@ class VistaBuilds(object):
         self.__buildRPCs = {} # from build components
         self.__buildsByPackageName = defaultdict()
         self.__packages = {}
-        limit = 1000 if self.vistaLabel == "GOLD" else VistaBuilds.__ALL_LIMIT
-        for i, buildResult in enumerate(self.__fmqlCacher.describeFileEntries("9_6", limit=limit, cstop=10000)):
-            # logging.info("... build result %d" % i)
-            dr = FMQLDescribeResult(buildResult)
-            self.__noSpecificValues += dr.noSpecificValues()
-            name = buildResult["name"]["value"]
-            if name in self.__buildAbouts:
-                raise Exception("Two builds in this VistA have the same name %s - breaks assumptions" % name)
-            # Don't show FMQL itself
-            if re.match(r'CGFMQL', name):
-                continue
-            self.__buildAbouts[name] = dr.cstopped(flatten=True)
-            if "package_file_link" in buildResult:
-                packageName = buildResult["package_file_link"]["label"].split("/")[1]
-                self.__buildAbouts[name]["vse:package_name"] = packageName
-                self.__buildAbouts[name]["vse:package"] = buildResult["package_file_link"]["value"]
-                self.__buildsByPackageName[packageName] = name
-                self.__packages[buildResult["package_file_link"]["value"]] = packageName
-            self.__buildAbouts[name]["vse:ien"] = buildResult["uri"]["value"].split("-")[1]
-            self.__buildAbouts[name]["vse:status"] = "NEVER_INSTALLED" # overridden below
-            if "file" in dr.cnodeFields():
-                # catch missing 'file'. TBD: do verify version?
-                self.__buildFiles[name] = [cnode for cnode in dr.cnodes("file") if "file" in cnode]
-                # turn 1- form into straight file id. Note dd_number is optional
-                for fileAbout in self.__buildFiles[name]:
-                    fileAbout["vse:file_id"] = fileAbout["file"][2:]
-            if "global" in dr.cnodeFields():
-                self.__buildGlobals[name] = [cnode for cnode in dr.cnodes("global") if "global" in cnode]
-            if "multiple_build" in dr.cnodeFields():                
-                self.__buildMultiples[name] = [cnode for cnode in dr.cnodes("multiple_build") if "multiple_build" in cnode]
-            # TODO: required build for tracing if want to be full Build analysis framework
-            if "package_namespace_or_prefix" in dr.cnodeFields():
-                pass # may join?
-            # Strange structure: entry for all possibilities but only some have data
-            if "build_components" in dr.cnodeFields():
-                bcs = dr.cnodes("build_components")
-                for bc in bcs:
-                    if "entries" not in bc:
-                        continue
-                    if bc["build_component"] == "1-8994":
-                        self.__buildRPCs[name] = bc["entries"] 
-                    if bc["build_component"] == "1-9.8":
-                        self.__buildRoutines[name] = bc["entries"]
-                    continue
+        if not (self.__baseline and self.__indexBuildsAgainstBaseline()):
+            for i, buildResult in enumerate(self.__fmqlCacher.describeFileEntries("9_6", cstop=10000)):
+                # logging.info("... build result %d" % i)
+                self.__indexBuild(buildResult)
         logging.info("%s: Indexing, cleaning (with caching) %d builds took %s" % (self.vistaLabel, len(self.__buildAbouts), datetime.now()-start))
         self.__installAbouts = OrderedDict()
         noInstalls = 0
-        for i, installResult in enumerate(self.__fmqlCacher.describeFileEntries("9_7", limit=limit, cstop=0)):
+        for i, installResult in enumerate(self.__fmqlCacher.describeFileEntries("9_7", cstop=0)):
             # WV has entries with no status: usually there is a follow on with data 
             if "status" not in installResult:
                 logging.error("No 'status' in install %s" % installResult["uri"]["value"])
@@ -296,6 +287,144 @@ class VistaBuilds(object):
                         logging.error("De-installing an uninstalled build: %s" % installInfo["uri"])
 
         logging.info("%s: Indexing, cleaning (with caching) %d builds, %d installs took %s" % (self.vistaLabel, len(self.__buildAbouts), noInstalls, datetime.now()-start))    
+        saveSnapshot(self.__fmqlCacher, "VistaBuilds", VistaBuilds.__SNAPSHOT_QUERIES, {"noSpecificValues": self.__noSpecificValues, "buildAbouts": self.__buildAbouts, "buildFiles": self.__buildFiles, "buildMultiples": self.__buildMultiples, "buildGlobals": self.__buildGlobals, "buildRoutines": self.__buildRoutines, "buildRPCs": self.__buildRPCs, "buildsByPackageName": self.__buildsByPackageName, "packages": self.__packages, "installAbouts": self.__installAbouts, "buildAboutsInstalled": self.__buildAboutsInstalled, "baseline": baselineFingerprint})
+
+    def __indexBuild(self, buildResult):
+        """Index a build described in full (CSTOP 10000)"""
+        dr = FMQLDescribeResult(buildResult)
+        self.__noSpecificValues += dr.noSpecificValues()
+        name = buildResult["name"]["value"]
+        if name in self.__buildAbouts:
+            raise Exception("Two builds in this VistA have the same name %s - breaks assumptions" % name)
+        # Don't show FMQL itself
+        if re.match(r'CGFMQL', name):
+            return
+        self.__indexBuildAbout(name, buildResult)
+        if "file" in dr.cnodeFields():
+            # catch missing 'file'. TBD: do verify version?
+            self.__buildFiles[name] = [cnode for cnode in dr.cnodes("file") if "file" in cnode]
+            # turn 1- form into straight file id. Note dd_number is optional
+            for fileAbout in self.__buildFiles[name]:
+                fileAbout["vse:file_id"] = fileAbout["file"][2:]
+        if "global" in dr.cnodeFields():
+            self.__buildGlobals[name] = [cnode for cnode in dr.cnodes("global") if "global" in cnode]
+        if "multiple_build" in dr.cnodeFields():                
+            self.__buildMultiples[name] = [cnode for cnode in dr.cnodes("multiple_build") if "multiple_build" in cnode]
+        # TODO: required build for tracing if want to be full Build analysis framework
+        if "package_namespace_or_prefix" in dr.cnodeFields():
+            pass # may join?
+        # Strange structure: entry for all possibilities but only some have data
+        if "build_components" in dr.cnodeFields():
+            bcs = dr.cnodes("build_components")
+            for bc in bcs:
+                if "entries" not in bc:
+                    continue
+                if bc["build_component"] == "1-8994":
+                    self.__buildRPCs[name] = bc["entries"] 
+                if bc["build_component"] == "1-9.8":
+                    self.__buildRoutines[name] = bc["entries"]
+                continue
+
+                
+    def __indexBuildAbout(self, name, buildResult):
+        """Top level fields of a build, full or shallow (CSTOP 0)"""
+        self.__buildAbouts[name] = FMQLDescribeResult(buildResult).cstopped(flatten=True)
+        if "package_file_link" in buildResult:
+            packageName = buildResult["package_file_link"]["label"].split("/")[1]
+            self.__buildAbouts[name]["vse:package_name"] = packageName
+            self.__buildAbouts[name]["vse:package"] = buildResult["package_file_link"]["value"]
+            self.__buildsByPackageName[packageName] = name
+            self.__packages[buildResult["package_file_link"]["value"]] = packageName
+        self.__buildAbouts[name]["vse:ien"] = buildResult["uri"]["value"].split("-")[1]
+        self.__buildAbouts[name]["vse:status"] = "NEVER_INSTALLED" # overridden below
+                
+    # Most of a VistA's builds described one by one against a baseline.
+    # Past it, the VistA is far from the baseline and paging through every
+    # build in full takes far fewer queries.
+    MAX_DEEP_SHARE = 0.2
+                
+    def __indexBuildsAgainstBaseline(self):
+        """
+        Two passes over Builds (9.6) rather than one deep one:
+        - shallow (CSTOP 0): every build's name, IEN and top level fields
+        - deep (CSTOP 10000), build by build: only those the baseline doesn't
+        have or has with different top level fields
+        The rest take their files, globals, multiples, routines and RPCs from
+        the baseline. A build's top level includes when it was distributed 
+        so one that matches there is taken to be the same build throughout.
+        
+        For a VistA close to the baseline (ex/ a VA VistA vs GOLD), this
+        fetches a fraction of the full crawl. Specific values of builds from 
+        the baseline only count their top level.
+        
+        Returns False, having indexed nothing, if builds are better read in
+        one deep pass: they already are cached that way (ex/ a VistA cached
+        before baselines), there's no FMQL to fetch the shallow pass from or
+        more than MAX_DEEP_SHARE of them would be described one by one.
+        """
+        if self.__fmqlCacher.isFileCached("9_6", 10000):
+            return False
+        if not (self.__fmqlCacher.canFetch or self.__fmqlCacher.isFileCached("9_6", 0)):
+            return False
+        shallowResults = [buildResult for buildResult in self.__fmqlCacher.describeFileEntries("9_6", cstop=0) if not re.match(r'CGFMQL', buildResult["name"]["value"])]
+        inBaseline = set(shallowResult["uri"]["value"] for shallowResult in shallowResults if self.__matchesBaseline(shallowResult))
+        deepIENs = [shallowResult["uri"]["value"].split("-")[1] for shallowResult in shallowResults if shallowResult["uri"]["value"] not in inBaseline]
+        if len(deepIENs) > VistaBuilds.MAX_DEEP_SHARE * len(shallowResults):
+            logging.info("%s: Builds - %d of %d builds not in %s - describing all of them in full" % (self.vistaLabel, len(deepIENs), len(shallowResults), self.__baseline.vistaLabel))
+            return False
+        logging.info("%s: Builds - %d of %d builds not in %s - describing them in full" % (self.vistaLabel, len(deepIENs), len(shallowResults), self.__baseline.vistaLabel))
+        # one (or None) per IEN, in order
+        deepResults = self.__fmqlCacher.describeEntries("9_6", deepIENs, cstop=10000)
+        for shallowResult in shallowResults:
+            if shallowResult["uri"]["value"] not in inBaseline:
+                buildResult = next(deepResults)
+                if buildResult is None:
+                    raise Exception("FMQL of %s can't describe build %s (%s) in full - exiting" % (self.vistaLabel, shallowResult["name"]["value"], shallowResult["uri"]["value"]))
+                if buildResult["uri"]["value"] != shallowResult["uri"]["value"]:
+                    raise Exception("Expected build %s but got %s - exiting" % (shallowResult["uri"]["value"], buildResult["uri"]["value"]))
+                self.__indexBuild(buildResult)
+                continue
+            name = shallowResult["name"]["value"]
+            if name in self.__buildAbouts:
+                raise Exception("Two builds in this VistA have the same name %s - breaks assumptions" % name)
+            self.__noSpecificValues += FMQLDescribeResult(shallowResult).noSpecificValues()
+            self.__indexBuildAbout(name, shallowResult)
+            # cnodes name the build they're in
+            container = shallowResult["uri"]["value"]
+            for buildIndex, baselineCNodes in [(self.__buildFiles, self.__baseline.describeBuildFiles(name)), (self.__buildGlobals, self.__baseline.describeBuildGlobals(name)), (self.__buildMultiples, self.__baseline.describeBuildMultiples(name))]:
+                if baselineCNodes:
+                    buildIndex[name] = [dict(cnode, **{"vse:container": container}) for cnode in baselineCNodes]
+            if self.__baseline.describeBuildRoutines(name):
+                self.__buildRoutines[name] = self.__baseline.describeBuildRoutines(name)
+            if self.__baseline.describeBuildRPCs(name):
+                self.__buildRPCs[name] = self.__baseline.describeBuildRPCs(name)
+        return True
+                
+    def __matchesBaseline(self, shallowResult):
+        """
+        Same top level fields as the baseline's build of the same name. 
+        IENs differ from VistA to VistA so pointers aren't compared by value:
+        the package is compared by name, others only by presence.
+        """
+        name = shallowResult["name"]["value"]
+        try:
+            baselineAbout = self.__baseline.describeBuild(name)
+        except KeyError:
+            return False
+        fields = set()
+        for field, value in shallowResult.items():
+            if value["type"] == "cnodes" or field == "uri":
+                continue
+            fields.add(field)
+            if field not in baselineAbout:
+                return False
+            if value["type"] == "uri":
+                if field == "package_file_link" and value["label"].split("/")[1] != baselineAbout.get("vse:package_name"):
+                    return False
+                continue
+            if value["value"] != baselineAbout[field]:
+                return False
+        return fields == set(field for field in baselineAbout if not (field == "uri" or field.startswith("vse:")))
                         
 # ######################## Module Demo ##########################
                        
@@ -0,0 +1,143 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Module for caching many VistAs at once ex/ a monthly recrawl of a dozen sites.
+
+A fleet is a JSON file listing VistAs, each defined as on the command line:
+
+[
+    {"vista": "CGVISTA", "fmqlEP": "http://vista.caregraf.org/fmqlEP", "async": true},
+    {"vista": "VAVISTA", "host": "xx.xx.xx", "port": 9201, "access": "XXX", "verify": "YYY", "poolSize": 10}
+]
+
+"poolSize" caps the queries in flight to that VistA (defaults as for one VistA).
+
+"rate" (queries a second), "bandwidth" (reply bytes a second) and "hours" (ex/ "07:00-19:00", comma separated, when rate and bandwidth apply) shape the crawl of a VistA in clinical use (LoadShaper). A VistA without its own takes the fleet's (see crawlFleet).
+
+Every VistA is crawled (schema, builds, installs and packages) on its own thread so a slow site doesn't hold up the rest. They share one budget (CrawlBudget): no more than budget queries are in flight across the fleet, shared out fairly between the VistAs.
+
+TODO:
+- crawl the largest VistAs first
+"""
+
+import os
+import sys
+import json
+import threading
+import logging
+from datetime import datetime
+from copies.fmqlCacher import FMQLCacher, CrawlIncomplete
+from copies.fmqlConcurrency import CrawlBudget, LoadShaper
+from vistaSchema import VistaSchema
+from vistaBuilds import VistaBuilds
+from vistaPackages import VistaPackages
+
+__all__ = ['loadFleet', 'crawlFleet', 'makeLoadShaper']
+
+# Most queries in flight across a fleet
+BUDGET = 60
+
+def loadFleet(fleetFile):
+    """VistA definitions of a fleet file, checked"""
+    vistaDefs = json.load(open(fleetFile))
+    labels = set()
+    for vistaDef in vistaDefs:
+        if "vista" not in vistaDef:
+            raise Exception("Every VistA in %s needs a 'vista' name - exiting" % fleetFile)
+        if not ("fmqlEP" in vistaDef or "host" in vistaDef):
+            raise Exception("VistA %s has neither an 'fmqlEP' nor a 'host' - exiting" % vistaDef["vista"])
+        if vistaDef["vista"] in labels:
+            raise Exception("VistA %s is in %s twice - exiting" % (vistaDef["vista"], fleetFile))
+        labels.add(vistaDef["vista"])
+    return vistaDefs
+
+def makeLoadShaper(shaping, label=""):
+    """
+    LoadShaper for shaping ({"rate", "bandwidth", "hours"} as in a fleet
+    file) or None if it sets neither rate nor bandwidth
+    """
+    if shaping.get("rate") is None and shaping.get("bandwidth") is None:
+        return None
+    hours = shaping.get("hours") or []
+    if isinstance(hours, basestring):
+        hours = [window.strip() for window in hours.split(",") if window.strip()]
+    rate = shaping.get("rate")
+    bandwidth = shaping.get("bandwidth")
+    return LoadShaper(None if rate is None else float(rate), None if bandwidth is None else int(bandwidth), hours, label)
+
+def crawlFleet(vistaDefs, cachesLocation="Caches", budget=BUDGET, refresh=False, shaping=None):
+    """
+    Crawl (or, with refresh, refresh) every VistA of a fleet at once. Builds
+    are crawled against GOLD's (see VistaBuilds) if GOLD is cached.
+    
+    shaping ({"rate", "bandwidth", "hours"}) shapes the crawls of VistAs
+    that don't set their own.
+
+    Returns {vista: None if cached or what went wrong}. One VistA failing
+    doesn't stop the rest.
+    """
+    crawlBudget = CrawlBudget(budget)
+    goldCacher = None
+    goldBuilds = None
+    if os.path.exists(os.path.join(cachesLocation, "GOLD")) or os.path.exists(os.path.join(cachesLocation, "GOLD.zip")):
+        goldCacher = FMQLCacher(cachesLocation)
+        goldCacher.setVista("GOLD")
+        goldBuilds = VistaBuilds("GOLD", goldCacher)
+    outcomes = {}
+    threads = []
+    for vistaDef in vistaDefs:
+        thread = threading.Thread(target=_crawlVista, args=(vistaDef, cachesLocation, crawlBudget, goldBuilds, refresh, shaping or {}, outcomes))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.isAlive():
+            thread.join(60) # timeout keeps the wait interruptible (Ctrl-C)
+    if goldCacher:
+        goldCacher.close()
+    return outcomes
+
+def _crawlVista(vistaDef, cachesLocation, crawlBudget, goldBuilds, refresh, shaping, outcomes):
+    vista = vistaDef["vista"]
+    start = datetime.now()
+    cacher = FMQLCacher(cachesLocation)
+    try:
+        ownShaping = dict((key, vistaDef[key]) for key in ["rate", "bandwidth", "hours"] if key in vistaDef)
+        loadShaper = makeLoadShaper(ownShaping or shaping, vista)
+        cacher.setVista(vista, fmqlEP=vistaDef.get("fmqlEP", ""), host=vistaDef.get("host", ""), port=int(vistaDef.get("port", -1)), access=vistaDef.get("access", ""), verify=vistaDef.get("verify", ""), poolSize=vistaDef.get("poolSize"), asyncFetch=vistaDef.get("async", False), budget=crawlBudget, loadShaper=loadShaper)
+        if refresh:
+            cacher.refresh()
+        VistaSchema(vista, cacher)
+        VistaBuilds(vista, cacher, goldBuilds)
+        VistaPackages(vista, cacher)
+        outcomes[vista] = None
+        logging.info("%s: cached in %s" % (vista, datetime.now() - start))
+    except CrawlIncomplete, ci:
+        outcomes[vista] = "%d queries couldn't be cached - rerun to fetch just them" % len(ci.summary.deadLetters)
+        logging.error("%s: %s" % (vista, outcomes[vista]))
+    except Exception, e:
+        outcomes[vista] = str(e) or e.__class__.__name__
+        logging.exception("%s: crawl failed" % vista)
+    finally:
+        cacher.close()
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Crawl the fleet in the file named on the command line
+
+    $ python vistaFleet.py fleet.json
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    outcomes = crawlFleet(loadFleet(sys.argv[1]))
+    for vista in sorted(outcomes):
+        print "%s: %s" % (vista, outcomes[vista] or "cached")
+
+if __name__ == "__main__":
+    demo()
@@ -15,6 +15,7 @@ from datetime import timedelta, datetime
 import logging
 from collections import OrderedDict, defaultdict
 from copies.fmqlCacher import FMQLDescribeResult
+from vistaSnapshots import loadSnapshot, saveSnapshot
 
 __all__ = ['VistaPackages']
 
@@ -158,13 +159,26 @@ class VistaPackages(object):
             return []
         return [packageFileAbout["file"] for packageFileAbout in self.__packageFiles[packageName]]
             
-    __ALL_LIMIT = 200
     __CSTOP = 10000
+    __SNAPSHOT_QUERIES = ["DESCRIBE 9_4 "]
         
     def __indexNCleanPackages(self):
         """
-        Index and clean packages - will force caching if not already in cache
-        """
+        Index and clean packages - will force caching if not already in cache.
+        Loads the indexes from a snapshot if the cache hasn't changed since
+        they were last built.
+        """
+        snapshot = loadSnapshot(self.__fmqlCacher, "VistaPackages", VistaPackages.__SNAPSHOT_QUERIES)
+        if snapshot:
+            self.__noSpecificValues = snapshot["noSpecificValues"]
+            self.__packageAbouts = snapshot["packageAbouts"]
+            self.__packageVersions = snapshot["packageVersions"]
+            self.__packageFiles = snapshot["packageFiles"]
+            self.__filesPackage = snapshot["filesPackage"]
+            self.__prefixes = snapshot["prefixes"]
+            self.__excludedPrefixes = snapshot["excludedPrefixes"]
+            logging.info("%s: Packages - loaded Packages Index from snapshot" % self.vistaLabel)
+            return
         logging.info("%s: Packages - packaging Packages Index ..." % self.vistaLabel)
         start = datetime.now()
         self.__noSpecificValues = 0
@@ -175,9 +189,8 @@ class VistaPackages(object):
         self.__filesPackage = {} # from file to Package
         self.__prefixes = defaultdict(list)
         self.__excludedPrefixes = defaultdict(list)
-        limit = 1000 if self.vistaLabel == "GOLD" else VistaPackages.__ALL_LIMIT
         cstop = 10 if self.vistaLabel == "GOLD" else VistaPackages.__CSTOP
-        for i, packageResult in enumerate(self.__fmqlCacher.describeFileEntries("9_4", limit=limit, cstop=cstop)):
+        for i, packageResult in enumerate(self.__fmqlCacher.describeFileEntries("9_4", cstop=cstop)):
             # logging.info("... package result %d" % i)
             dr = FMQLDescribeResult(packageResult)
             self.__noSpecificValues += dr.noSpecificValues()
@@ -217,6 +230,7 @@ class VistaPackages(object):
                     self.__excludedPrefixes[excluded].append(name)
                 
         logging.info("%s: Indexing, cleaning (with caching) %d packages took %s" % (self.vistaLabel, len(self.__packageAbouts), datetime.now()-start))
+        saveSnapshot(self.__fmqlCacher, "VistaPackages", VistaPackages.__SNAPSHOT_QUERIES, {"noSpecificValues": self.__noSpecificValues, "packageAbouts": self.__packageAbouts, "packageVersions": self.__packageVersions, "packageFiles": self.__packageFiles, "filesPackage": self.__filesPackage, "prefixes": self.__prefixes, "excludedPrefixes": self.__excludedPrefixes})
         
 # ######################## Module Demo ##########################
                        
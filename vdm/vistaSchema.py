@@ -30,6 +30,7 @@ import json
 import sys
 from datetime import timedelta, datetime 
 import logging
+from vistaSnapshots import loadSnapshot, saveSnapshot
 
 __all__ = ['VistaSchema']
 
@@ -86,6 +87,10 @@ class VistaSchema(object):
     def getSchema(self, file):
         return self.__schemas[file]
         
+    def getSchemaHash(self, file):
+        """Hash of the file's cached description. Equal hashes, equal schemas."""
+        return self.__fmqlCacher.replyHash("DESCRIBE TYPE " + file)
+        
     def getFileName(self, file):
         if file not in self.__schemas:
             return "<INVALID FILE>"
@@ -122,10 +127,19 @@ class VistaSchema(object):
     def dotFiles(self, fileSet):
         return [float(re.sub(r'\_', ".", item)) for item in fileSet]
                             
+    __SNAPSHOT_QUERIES = ["SELECT TYPES", "DESCRIBE TYPE "]
+                            
     def __makeSchemas(self):
         """
-        Index schema - will force caching if not already in cache
+        Index schema - will force caching if not already in cache. Loads
+        the index from a snapshot if the cache hasn't changed since it was
+        last built.
         """
+        snapshot = loadSnapshot(self.__fmqlCacher, "VistaSchema", VistaSchema.__SNAPSHOT_QUERIES)
+        if snapshot:
+            self.__schemas, self.badSelectTypes = snapshot
+            logging.info("%s: Schema - loaded Schema Index from snapshot" % self.vistaLabel)
+            return
         logging.info("%s: Schema - building Schema Index ..." % self.vistaLabel)
         schemas = {}
         start = datetime.now()
@@ -138,6 +152,7 @@ class VistaSchema(object):
             schemas[fmqlFileId] = dtResult
         logging.info("%s: ... building (with caching) took %s" % (self.vistaLabel, datetime.now()-start))
         self.__schemas = schemas
+        saveSnapshot(self.__fmqlCacher, "VistaSchema", VistaSchema.__SNAPSHOT_QUERIES, (self.__schemas, self.badSelectTypes))
 
 # ######################## Module Demo ##########################
                        
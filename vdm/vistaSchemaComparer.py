@@ -92,6 +92,7 @@ class VistaSchemaComparer(object):
         counts["noBNotOFields"] = 0
         counts["noONotBFields"] = 0
         counts["norenamedFields"] = 0
+        counts["noIdenticalFiles"] = 0
         for no, fmqlFileId in enumerate(bothFiles, start=1):
             fileId = re.sub(r'\_', '.', fmqlFileId)
             bsch = self.__bSchema.getSchema(fmqlFileId)
@@ -102,6 +103,12 @@ class VistaSchemaComparer(object):
             if re.match(r'63', fileId):
                 reportBuilder.both(no, fileId, bsch["name"], osch["name"], loc, parent, 0, 0, {})
                 continue
+            # Identical descriptions (the same reply hash) - nothing to diff. Counts are from SELECT TYPES so may still differ.
+            bHash = self.__bSchema.getSchemaHash(fmqlFileId)
+            if bHash and bHash == self.__oSchema.getSchemaHash(fmqlFileId):
+                counts["noIdenticalFiles"] += 1
+                reportBuilder.both(no, fileId, bsch["name"], osch["name"], loc, parent, self.__safeCount(bsch), self.__safeCount(osch), {})
+                continue
             bFieldIds = self.__bSchema.getFieldIds(fmqlFileId)
             bCount = self.__safeCount(bsch)
             oFieldIds = self.__oSchema.getFieldIds(fmqlFileId)
@@ -333,7 +340,7 @@ class VSHTMLReportBuilder:
     # Change to a dict as too long for anything else.
     def counts(self, counts): 
         
-        self.__countsETCMU = "<div class='report' id='counts'><h2>Schema Counts</h2><dl><dt>Overall</dt><dd>%d files, %d in both</dd><dt>%s (\"Baseline\")</dt><dd>%d files, %d tops, %d multiples, %d unique, %d populated (%.1f%%)<br/>%d fields, %d in shared files, %d unique</dd><dt>%s (\"Other\")</dt><dd>%d files, %d tops, %d multiples, <span class='highlight'>%d unique (%.1f%%)</span>, %d populated (%.1f%%)<br/>%d fields, %d in shared files, <span class='highlight'>%d unique, %d repurposed, %d custom (%.1f%%)</span></dd></dl></div>" % (counts["allFiles"], counts["bothFiles"], self.__bVistaLabel, counts["baseFiles"], counts["baseTops"], counts["baseMultiples"], counts["baseOnlyFiles"], counts["basePopTops"], round(((float(counts["basePopTops"])/float(counts["baseTops"])) * 100), 2), counts["baseCountFields"], counts["baseBothCountFields"], counts["noBNotOFields"], self.__oVistaLabel, counts["otherFiles"], counts["otherTops"], counts["otherMultiples"], counts["otherOnlyFiles"], round(((float(counts["otherOnlyFiles"])/float(counts["otherFiles"])) * 100), 2), counts["otherPopTops"], round(((float(counts["otherPopTops"])/float(counts["otherTops"])) * 100), 2), counts["otherCountFields"], counts["otherBothCountFields"], counts["noONotBFields"], counts["norenamedFields"], counts["noONotBFields"] + counts["norenamedFields"], round(((float(counts["noONotBFields"] + counts["norenamedFields"])/float(counts["otherBothCountFields"])) * 100), 2)) 
+        self.__countsETCMU = "<div class='report' id='counts'><h2>Schema Counts</h2><dl><dt>Overall</dt><dd>%d files, %d in both, %d of them identical</dd><dt>%s (\"Baseline\")</dt><dd>%d files, %d tops, %d multiples, %d unique, %d populated (%.1f%%)<br/>%d fields, %d in shared files, %d unique</dd><dt>%s (\"Other\")</dt><dd>%d files, %d tops, %d multiples, <span class='highlight'>%d unique (%.1f%%)</span>, %d populated (%.1f%%)<br/>%d fields, %d in shared files, <span class='highlight'>%d unique, %d repurposed, %d custom (%.1f%%)</span></dd></dl></div>" % (counts["allFiles"], counts["bothFiles"], counts["noIdenticalFiles"], self.__bVistaLabel, counts["baseFiles"], counts["baseTops"], counts["baseMultiples"], counts["baseOnlyFiles"], counts["basePopTops"], round(((float(counts["basePopTops"])/float(counts["baseTops"])) * 100), 2), counts["baseCountFields"], counts["baseBothCountFields"], counts["noBNotOFields"], self.__oVistaLabel, counts["otherFiles"], counts["otherTops"], counts["otherMultiples"], counts["otherOnlyFiles"], round(((float(counts["otherOnlyFiles"])/float(counts["otherFiles"])) * 100), 2), counts["otherPopTops"], round(((float(counts["otherPopTops"])/float(counts["otherTops"])) * 100), 2), counts["otherCountFields"], counts["otherBothCountFields"], counts["noONotBFields"], counts["norenamedFields"], counts["noONotBFields"] + counts["norenamedFields"], round(((float(counts["noONotBFields"] + counts["norenamedFields"])/float(counts["otherBothCountFields"])) * 100), 2)) 
                                 
     def flush(self):
     
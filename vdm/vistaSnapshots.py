@@ -0,0 +1,65 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Module for saving and loading "crunched" VistA indexes - what VistaSchema, VistaBuilds and VistaPackages build from a VistA's cached FMQL replies. 
+
+A snapshot is a compressed binary pickle of an index, saved beside the VistA caches in "Snapshots". Its header holds the VDM version and the fingerprint of the cached queries the index was crunched from (ex/ the pages of 9.6 and 9.7 for Builds). A snapshot only loads if both still match, so any change to the cache or a new version of VDM means crunching again.
+
+TODO:
+- clear out snapshots of caches that are gone
+"""
+
+import os
+import re
+import zlib
+import cPickle
+import logging
+from vdmU import __version__ as VDM_VERSION
+
+__all__ = ['loadSnapshot', 'saveSnapshot']
+
+# Bump if what a snapshot holds changes within a VDM version
+SNAPSHOT_FORMAT = 1
+
+def _snapshotFile(fmqlCacher, kind):
+    snapshotsLocation = os.path.join(os.path.dirname(fmqlCacher.cacheLocation), "Snapshots")
+    return os.path.join(snapshotsLocation, "%s_%s.snapshot" % (re.sub(r' ', '_', fmqlCacher.vistaLabel), kind))
+    
+def _header(fmqlCacher, queryPrefixes):
+    return "VDMSNAPSHOT %d %s %s\n" % (SNAPSHOT_FORMAT, VDM_VERSION, fmqlCacher.fingerprint(queryPrefixes))
+
+def loadSnapshot(fmqlCacher, kind, queryPrefixes):
+    """
+    Indexes of kind (ex/ "VistaBuilds") crunched from this cache's queries 
+    starting with queryPrefixes or None if there is no snapshot or it is 
+    out of date.
+    """
+    snapshotFile = _snapshotFile(fmqlCacher, kind)
+    if not os.path.isfile(snapshotFile):
+        return None
+    try:
+        with open(snapshotFile, "rb") as sf:
+            if sf.readline() != _header(fmqlCacher, queryPrefixes):
+                logging.info("%s: %s snapshot is out of date" % (fmqlCacher.vistaLabel, kind))
+                return None
+            return cPickle.loads(zlib.decompress(sf.read()))
+    except Exception as e:
+        logging.error("%s: can't load %s snapshot (%s) - will crunch again" % (fmqlCacher.vistaLabel, kind, str(e)))
+        return None
+
+def saveSnapshot(fmqlCacher, kind, queryPrefixes, indexes):
+    snapshotFile = _snapshotFile(fmqlCacher, kind)
+    try:
+        if not os.path.exists(os.path.dirname(snapshotFile)):
+            os.mkdir(os.path.dirname(snapshotFile))
+        with open(snapshotFile, "wb") as sf:
+            sf.write(_header(fmqlCacher, queryPrefixes))
+            sf.write(zlib.compress(cPickle.dumps(indexes, cPickle.HIGHEST_PROTOCOL)))
+    except Exception as e:
+        # only a speed up so don't stop
+        logging.error("%s: can't save %s snapshot (%s)" % (fmqlCacher.vistaLabel, kind, str(e)))